@@ -7,8 +7,81 @@ config_path = os.path.normpath(os.path.dirname(__file__))
 server_name = 'lessandro.com'
 ping_timeout = 999999999
 
+# answer PINGs and disconnect idle users in the servers instead of the kernel,
+# keepalive traffic then never goes through redis
+endpoint_keepalive = False
+
+# max number of messages read from each lane of the kernel queue in one round
+# trip
+batch_size = 100
+
+# number of kernel processes, each one owning a range of channels and nicks
+kernel_shards = 1
+
+# number of threads processing messages concurrently in each kernel, messages
+# for the same channel or nick stay in order (0 disables the pool)
+workers = 0
+
+# read the kernel queues from redis streams through a consumer group instead
+# of lists, messages of a batch are only acknowledged once processed
+streams = False
+
+# approximate max number of entries kept in each stream
+stream_maxlen = 100000
+
+# a message delivered more times than this, because the kernel died while
+# processing it, is moved to the <stream>:dead stream
+stream_max_deliveries = 3
+
 hmac_key = 'secret'
 
+# seconds between deletions of the expired timed ACCESS entries
+access_reap_interval = 60
+
+# channels with more members than this don't send the names when a user joins
+# (the user can still ask with NAMES), 0 for no limit
+join_names_limit = 1000
+
+# buffer the redis writes of each message in a single pipeline
+pipeline = False
+
+# keep an in-memory copy of the user and channel data
+cache = False
+
+# compare the cache with redis after every message (slow, for tests)
+cache_check = False
+
+# max length of a line from a client, including the line ending
+max_line_length = 512
+
+# max bytes of an unfinished line kept for a client, clients that send more
+# are disconnected
+max_buffer = 8192
+
+# max bytes of output waiting to be written to a client, clients that don't
+# read fast enough are disconnected
+max_sendq = 262144
+
+# output for a client is written once per ioloop iteration, or as soon as this
+# many bytes are waiting
+flush_size = 16384
+
+# flood control, lines per second and burst allowed for each connection and
+# for all the connections from the same address. lines over the limit are
+# delayed, clients that would wait more than flood_max_delay seconds are
+# disconnected
+flood_rate = 2
+flood_burst = 10
+flood_ip_rate = 10
+flood_ip_burst = 50
+flood_max_delay = 10
+
+# the servers stop reading from clients while the kernel is more than
+# backpressure_high seconds behind, and start again once it is less than
+# backpressure_low seconds behind (only tcp clients, sockjs can't be paused)
+backpressure_high = 5
+backpressure_low = 1
+
 # socket server
 
 tcp_port = 5556
@@ -0,0 +1,39 @@
+import msgpack
+import time
+
+# bumped whenever the layout of the envelopes changes, so that a kernel and
+# servers running different versions refuse each other's messages instead of
+# misreading them
+VERSION = 2
+
+
+def dumps(*fields):
+    """
+    Serialize an envelope: a version byte followed by the msgpack encoded
+    list of fields
+
+    Messages to the kernel are (kind, origin, data, sent), see message().
+    Messages to the servers are (tags, line), an empty line disconnects the
+    tags.
+    """
+    return chr(VERSION) + msgpack.dumps(fields)
+
+
+def message(kind, origin, data):
+    """
+    Serialize a message to the kernel
+
+    data is [command, params] for user messages. The message is stamped with
+    the time it was sent, to measure how long it waited in the queue.
+    """
+    return dumps(kind, origin, data, time.time())
+
+
+def loads(frame):
+    """
+    Deserialize an envelope into its list of fields
+    """
+    version = ord(frame[0:1] or '\0')
+    if version != VERSION:
+        raise ValueError('unsupported envelope version %d' % version)
+    return msgpack.loads(frame[1:])
@@ -0,0 +1,72 @@
+from util import split
+from ..kernel.replies import replies
+
+# number of parameters of each command known to the kernel, the last one
+# takes the rest of the line (must match the signatures of the irc_* command
+# functions)
+params = {
+    'ACCESS': 6,
+    'AUTH': 2,
+    'AWAY': 1,
+    'JOIN': 1,
+    'KICK': 3,
+    'MODE': 2,
+    'NAMES': 1,
+    'NICK': 1,
+    'NOTICE': 2,
+    'PART': 1,
+    'PING': 1,
+    'PONG': 1,
+    'PRIVMSG': 2,
+    'QUIT': 1,
+    'TOPIC': 2,
+    'USER': 4,
+    'WHO': 1,
+}
+
+
+class ParseError(Exception):
+    """
+    A line that is rejected without reaching the kernel
+
+    Carries the numeric and text of the error reply sent back to the client,
+    taken from the kernel replies.
+    """
+    def __init__(self, reply, *args):
+        numeric, format = replies[reply]
+        super(ParseError, self).__init__(numeric, format % args)
+        self.numeric = numeric
+        self.text = format % args
+
+
+def tokenize(line):
+    """
+    Split a line into its upper-cased command and its parameters
+
+    Lines of unknown commands have a single parameter, the rest of the line.
+    """
+    cmd, args = split(line, 1)
+    cmd = cmd.upper()
+    return cmd, split(args, params.get(cmd, 1) - 1)
+
+
+def parse(line, max_length):
+    """
+    Validate and tokenize a line received from a client
+
+    max_length includes the line ending. Raises ParseError for lines that are
+    too long, are not UTF-8 or have an unknown command.
+    """
+    if len(line) + 2 > max_length:
+        raise ParseError('ERR_INPUTTOOLONG')
+
+    try:
+        line.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ParseError('ERR_NONUTF8')
+
+    cmd, args = tokenize(line)
+    if cmd not in params:
+        raise ParseError('ERR_UNKNOWNCOMMAND', cmd)
+
+    return cmd, args
@@ -0,0 +1,87 @@
+import zlib
+from util import split
+
+# commands whose first parameter is a channel
+chan_commands = set([
+    'JOIN', 'PART', 'PRIVMSG', 'NOTICE', 'TOPIC', 'NAMES', 'WHO', 'KICK',
+    'MODE', 'ACCESS'
+])
+
+# commands whose first parameter can also be a nick
+nick_commands = set(['PRIVMSG', 'NOTICE'])
+
+
+def shard_of(name, shards):
+    """
+    Map a channel, nick or tag to the kernel shard that owns it
+
+    The 32 bit hash space is split in shards equal ranges.
+    """
+    return (zlib.crc32(name) & 0xffffffff) * shards >> 32
+
+
+# message kinds that go ahead of the user messages. a disconnect stays behind
+# the messages of its user, which would be lost otherwise
+high_priority = frozenset(['connect', 'reset', 'shutdown'])
+
+# queue lanes of each kernel shard, in the order they are consumed
+lanes = ['high', 'normal']
+
+
+def lane_of(kind):
+    """
+    Lane of the kernel queue a kind of message goes to
+    """
+    return 'high' if kind in high_priority else 'normal'
+
+
+def kernel_queue(shard, shards, lane='normal'):
+    """
+    Name of a lane of the message queue consumed by a kernel shard
+    """
+    name = 'mq:kernel' if shards == 1 else 'mq:kernel:%d' % shard
+    if lane != 'normal':
+        name += ':' + lane
+    return name
+
+
+def lag_key(shard):
+    """
+    Name of the key where a kernel shard publishes how far behind it is
+    """
+    return 'kernel-lag:%d' % shard
+
+
+def route(tag, cmd, params, shards):
+    """
+    Split the parameters of a user command into (shard, params) pairs
+
+    Channel commands go to the shard that owns the channel (a JOIN with
+    channels in several shards is split), PRIVMSG and NOTICE to a nick go to
+    the shard that owns the nick and everything else goes to the user's home
+    shard, which is the one that owns the tag.
+    """
+    home = shard_of(tag, shards)
+    if shards == 1:
+        return [(home, params)]
+
+    # commands with a single parameter get the whole line in it
+    target, rest = split(params[0], 1)
+
+    if cmd not in chan_commands or not target:
+        return [(home, params)]
+
+    if target[0] != '#':
+        if cmd in nick_commands:
+            return [(shard_of(target, shards), params)]
+        return [(home, params)]
+
+    if cmd != 'JOIN':
+        return [(shard_of(target, shards), params)]
+
+    chans = {}
+    for chan_name in target.split(','):
+        chans.setdefault(shard_of(chan_name, shards), []).append(chan_name)
+
+    return [(shard, [('%s %s' % (','.join(names), rest)).strip()])
+            for shard, names in sorted(chans.items())]
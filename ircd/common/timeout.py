@@ -0,0 +1,81 @@
+import threading
+import time
+import wheel
+
+
+class Timeout(object):
+    """
+    Ping timeout tracker
+
+    The server will wait for ping_timeout seconds of inactivity to
+    send a PING message, then wait for ping_timeout more seconds before
+    disconnecting the user.
+
+    Every tag is scheduled once in a timing wheel. Messages only update the
+    time the tag was last seen; the tag is rescheduled when its check comes up
+    and it turns out to have been active.
+
+    The server must have send(tag, line) and disconnect(user) methods, like
+    the kernel.
+
+    The tracker can be shared by threads, like the workers of the kernel.
+    """
+    def __init__(self, server, config):
+        self.server = server
+        self.name = config.server_name
+        self.ping_timeout = config.ping_timeout
+
+        # tags to check later, each one at most once
+        self.wheel = wheel.TimingWheel(time.time())
+
+        # tag -> (last seen, sent ping?)
+        self.last_seen = {}
+
+        # reentrant, disconnecting a user during check() removes its tag
+        self.lock = threading.RLock()
+
+    def check(self):
+        """
+        Check the tags that are due to see who needs to be pinged or
+        disconnected
+        """
+        with self.lock:
+            self._check(time.time())
+
+    def _check(self, now):
+        for tag in self.wheel.advance(now):
+            last_message, sent_ping = self.last_seen[tag]
+
+            if now - last_message >= 2 * self.ping_timeout:
+                if sent_ping:
+                    self.server.disconnect({'tag': tag})
+                    # remove tag from tracker to avoid disconnecting twice
+                    self.remove(tag)
+                    continue
+
+            if now - last_message >= self.ping_timeout:
+                if not sent_ping:
+                    self.server.send(tag, 'PING :%s' % self.name)
+                    self.last_seen[tag] = (last_message, True)
+                self.wheel.add(tag, now + self.ping_timeout)
+            else:
+                # the user was active since the check was scheduled
+                self.wheel.add(tag, last_message + self.ping_timeout)
+
+    def update(self, tag):
+        """
+        Update the last_seen dict and schedule this tag for later checking
+        """
+        now = time.time()
+        with self.lock:
+            self.last_seen[tag] = (now, False)
+            if tag not in self.wheel:
+                self.wheel.add(tag, now + self.ping_timeout)
+
+    def remove(self, tag):
+        """
+        Stop tracking this tag
+        """
+        with self.lock:
+            self.last_seen.pop(tag, None)
+            self.wheel.remove(tag)
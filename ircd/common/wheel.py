@@ -0,0 +1,125 @@
+import math
+
+
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel
+
+    Schedules items to expire at a deadline, with a resolution of one tick.
+    Level 0 has one slot per tick and every slot of level n spans a whole
+    turn of level n - 1. Items are placed in the lowest level whose turn
+    contains their deadline and move down a level when the wheel reaches
+    their slot, so adding and removing an item are O(1).
+
+    Each item is scheduled at most once.
+    """
+    def __init__(self, now, resolution=1, bits=6, levels=5):
+        self.resolution = resolution
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = [[set() for _ in range(1 << bits)]
+                       for _ in range(levels)]
+        # number of items in each level
+        self.sizes = [0] * levels
+        # item -> (deadline tick, level, slot)
+        self.items = {}
+        self.tick = self._tick(now)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def _tick(self, t):
+        return int(math.ceil(t / self.resolution))
+
+    def add(self, item, deadline):
+        """
+        Schedule an item, which must not be scheduled already
+        """
+        self._place(item, max(self._tick(deadline), self.tick + 1))
+
+    def _place(self, item, deadline):
+        # the lowest level whose current turn contains the deadline
+        top = len(self.levels) - 1
+        level = 0
+        while level < top and \
+                deadline >> self.bits * (level + 1) != \
+                self.tick >> self.bits * (level + 1):
+            level += 1
+
+        slot = (deadline >> self.bits * level) & self.mask
+        self.levels[level][slot].add(item)
+        self.sizes[level] += 1
+        self.items[item] = (deadline, level, slot)
+
+    def remove(self, item):
+        """
+        Unschedule an item, if it is scheduled
+        """
+        if item not in self.items:
+            return
+
+        _, level, slot = self.items.pop(item)
+        self.levels[level][slot].discard(item)
+        self.sizes[level] -= 1
+
+    def advance(self, now):
+        """
+        Move the wheel forward to now and return the expired items
+        """
+        target = self._tick(now)
+        expired = []
+
+        while self.tick < target:
+            self.tick += 1
+            tick = self.tick
+
+            # move the items of the higher level slots that start now down
+            for level in range(1, len(self.levels)):
+                if tick & ((1 << self.bits * level) - 1):
+                    break
+                self._cascade(level, (tick >> self.bits * level) & self.mask)
+
+            slot = self.levels[0][tick & self.mask]
+            if slot:
+                self.sizes[0] -= len(slot)
+                for item in slot:
+                    del self.items[item]
+                expired.extend(slot)
+                slot.clear()
+
+            self._skip(target)
+
+        return expired
+
+    def _cascade(self, level, slot):
+        items = self.levels[level][slot]
+        if not items:
+            return
+
+        moved = list(items)
+        items.clear()
+        self.sizes[level] -= len(moved)
+        for item in moved:
+            self._place(item, self.items[item][0])
+
+    def _skip(self, target):
+        """
+        Jump over the ticks where nothing can happen: with nothing in the
+        levels below n, the next event is the start of a level n slot
+        """
+        for level, size in enumerate(self.sizes):
+            if size:
+                break
+        else:
+            self.tick = target
+            return
+
+        if level == 0:
+            return
+
+        span = self.bits * level
+        start = ((self.tick >> span) + 1) << span
+        self.tick = max(self.tick, min(target, start - 1))
@@ -0,0 +1,46 @@
+import collections
+import fnmatch
+import re
+import time
+
+_wildcard = re.compile(r'[*?[]')
+
+
+class Matcher(object):
+    """
+    A channel access list compiled for matching user ids
+
+    Masks without wildcards are looked up in a set per level, the other masks
+    of each level are combined into a single regex.
+    """
+    def __init__(self, entries):
+        exact = collections.defaultdict(set)
+        patterns = collections.defaultdict(list)
+        # earliest timeout of the entries, the matcher is stale after it
+        self.expires = 0
+
+        for level, mask, timeout, _, _ in entries:
+            if timeout > 0 and (not self.expires or timeout < self.expires):
+                self.expires = timeout
+
+            if _wildcard.search(mask):
+                patterns[level].append(fnmatch.translate(mask))
+            else:
+                exact[level].add(mask)
+
+        self.exact = dict(exact)
+        self.regexes = dict((level, re.compile('|'.join(masks)))
+                            for level, masks in patterns.iteritems())
+
+    def expired(self):
+        return 0 < self.expires < time.time()
+
+    def match(self, userid):
+        """
+        Return the set of levels with a mask that matches the user id
+        """
+        levels = set(level for level, masks in self.exact.iteritems()
+                     if userid in masks)
+        levels.update(level for level, regex in self.regexes.iteritems()
+                      if level not in levels and regex.match(userid))
+        return levels
@@ -0,0 +1,127 @@
+import msgpack as json
+import redisutil
+
+
+class Cache(object):
+    """
+    In-memory copy of the user and channel data
+
+    The kernel is the only process that writes the user:*, chan:*,
+    chan-nicks:*, chan-users:* and user-chans:* keys, so this copy is
+    authoritative: the kernel reads from it and writes through to redis.
+
+    Redis is still the persistent store. The cache is rebuilt from it when the
+    kernel starts, which keeps hot-swapping working.
+    """
+    def __init__(self):
+        # tag -> user
+        self.users = {}
+        # chan name -> chan
+        self.chans = {}
+        # chan name -> {nick -> data}
+        self.chan_nicks = {}
+        # chan name -> set of tags
+        self.chan_users = {}
+        # tag -> set of chan names
+        self.user_chans = {}
+
+    def load(self, redis, tags):
+        """
+        Rebuild the cache from the data in redis of the given users
+
+        Channels always have users, so the users' channels are all the
+        channels there are. Reads are pipelined in batches.
+        """
+        self.__init__()
+
+        for batch in redisutil.batches(list(tags)):
+            pipe = redis.pipeline(False)
+            for tag in batch:
+                pipe.get('user:' + tag)
+                pipe.smembers('user-chans:' + tag)
+            results = pipe.execute()
+
+            for tag, user, chans in zip(batch, results[::2], results[1::2]):
+                if user:
+                    self.users[tag] = json.loads(user)
+                if chans:
+                    self.user_chans[tag] = chans
+
+        chan_names = set()
+        for chans in self.user_chans.itervalues():
+            chan_names.update(chans)
+
+        for batch in redisutil.batches(list(chan_names)):
+            pipe = redis.pipeline(False)
+            for name in batch:
+                pipe.get('chan:' + name)
+                pipe.hgetall('chan-nicks:' + name)
+                pipe.smembers('chan-users:' + name)
+            results = pipe.execute()
+
+            for i, name in enumerate(batch):
+                chan, nicks, users = results[i * 3:i * 3 + 3]
+                if chan:
+                    self.chans[name] = json.loads(chan)
+                if nicks:
+                    self.chan_nicks[name] = dict(
+                        (nick, json.loads(data))
+                        for nick, data in nicks.iteritems())
+                if users:
+                    self.chan_users[name] = users
+
+    def load_all(self, redis):
+        """
+        Rebuild the cache from all the matching keys in redis, including the
+        ones no user refers to
+        """
+        self.__init__()
+        self.users.update(self._load_values(redis, 'user:'))
+        self.chans.update(self._load_values(redis, 'chan:'))
+
+        pipe = redis.pipeline(False)
+        keys = list(redisutil.scan(redis, 'chan-nicks:*'))
+        for key in keys:
+            pipe.hgetall(key)
+        for key, nicks in zip(keys, pipe.execute()):
+            self.chan_nicks[key.split(':', 1)[1]] = dict(
+                (nick, json.loads(data)) for nick, data in nicks.iteritems())
+
+        self.chan_users.update(self._load_sets(redis, 'chan-users:'))
+        self.user_chans.update(self._load_sets(redis, 'user-chans:'))
+
+    def _load_values(self, redis, prefix):
+        keys = list(redisutil.scan(redis, prefix + '*'))
+        values = redis.mget(keys) if keys else []
+        return [(key.split(':', 1)[1], json.loads(value))
+                for key, value in zip(keys, values) if value]
+
+    def _load_sets(self, redis, prefix):
+        pipe = redis.pipeline(False)
+        keys = list(redisutil.scan(redis, prefix + '*'))
+        for key in keys:
+            pipe.smembers(key)
+        return [(key.split(':', 1)[1], members)
+                for key, members in zip(keys, pipe.execute())]
+
+    def diff(self, redis):
+        """
+        Compare the cache against redis
+
+        Returns a list of the keys whose contents differ.
+        """
+        other = Cache()
+        other.load_all(redis)
+
+        diffs = []
+        for prefix, attr in [('user:', 'users'), ('chan:', 'chans'),
+                             ('chan-nicks:', 'chan_nicks'),
+                             ('chan-users:', 'chan_users'),
+                             ('user-chans:', 'user_chans')]:
+            mine = getattr(self, attr)
+            theirs = getattr(other, attr)
+            for name in set(mine) | set(theirs):
+                if mine.get(name) != theirs.get(name):
+                    diffs.append(prefix + name)
+
+        return sorted(diffs)
@@ -1,5 +1,3 @@
-from ..common.util import split
-
 commands = {}
 
 
@@ -37,6 +35,9 @@ def validate(name, server, user, args, params):
             server.send_reply(user, 'ERR_NEEDMOREPARAMS', name)
             return False
 
+    if 'chan' in params or 'prefetch' in params:
+        server.prefetch_chans(user, args[0].split(','))
+
     if 'chan' in params:
         chan_name = args[0]
         chan = args[0] = server.find_chan(chan_name)
@@ -69,16 +70,18 @@ def command(f_=None, **kwargs):
     return decorator(f_) if f_ else decorator
 
 
-def dispatch(server, user, message):
-    cmd, args = split(message, 1)
-    cmd = cmd.upper()
-
+def dispatch(server, user, cmd, params):
     if cmd not in commands:
         server.send_reply(user, 'ERR_UNKNOWNCOMMAND', cmd)
         return
 
     f, arity = commands[cmd]
-    f(server, user, *split(args, arity - 1))
+    # the servers tokenize the lines, they may not agree on the arity
+    if len(params) != arity:
+        server.send_reply(user, 'ERR_NEEDMOREPARAMS', cmd)
+        return
+
+    f(server, user, *params)
 
 
 def load_commands():
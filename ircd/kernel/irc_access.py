@@ -1,7 +1,6 @@
 from command import command, is_op, is_owner
 from ..common.util import decolon
 import time
-import fnmatch
 
 levels = {
     '': (0, ''),
@@ -55,13 +54,16 @@ def cmd_access(server, user, chan, action, level, mask, timeout, reason):
         server.send_reply(user, 'RPL_ACCESSDELETE', chan['name'], level, mask)
 
     elif action == 'CLEAR':
+        entries = []
         for level_, mask, _, _, _ in get_access_list(server, chan):
             if level and level != level_:
                 continue
             if level_ == 'OWNER' and not is_owner_:
                 continue
 
-            server.access_list_del(chan, level_, mask)
+            entries.append((level_, mask))
+
+        server.access_list_del_many(chan, entries)
 
         server.send_reply(user, 'RPL_ACCESSCLEAR', chan['name'], level)
 
@@ -116,22 +118,16 @@ def timeout_minutes(timeout):
 
 
 def get_access_list(server, chan):
-    now = time.time()
-    for entry in server.access_list_all(chan):
-        level, mask, timeout, _, _ = entry
-        if timeout > 0 and timeout < now:
-            server.access_list_del(chan, level, mask)
-        else:
-            yield entry
+    # expired entries are removed by the kernel
+    return server.access_list_all(chan)
 
 
 def check_user_access(server, chan, user):
-    acl = get_access_list(server, chan)
+    matcher = server.access_matcher(chan)
     best_level = levels['']
 
-    for level, mask, _, _, _ in acl:
-        if fnmatch.fnmatch(user['id'], mask):
-            if levels[level] > best_level:
-                best_level = levels[level]
+    for level in matcher.match(user['id']):
+        if levels[level] > best_level:
+            best_level = levels[level]
 
     return best_level[1]
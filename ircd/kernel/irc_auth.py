@@ -124,4 +124,4 @@ def check_auth(server, user):
 
     hex_data = msgpack.dumps(data).encode('hex')
     h = hmac.new(server.config.hmac_key, hex_data, hashlib.sha256)
-    dispatch(server, user, 'AUTH %s %s' % (hex_data, h.hexdigest()))
+    dispatch(server, user, 'AUTH', [hex_data, h.hexdigest()])
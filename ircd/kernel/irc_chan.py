@@ -5,6 +5,9 @@ import irc_access
 
 chan_re = re.compile(r'^#\w+$')
 
+# max length of a line sent to a user, including the line ending
+max_line_length = 512
+
 
 def join_chan(server, user, chan_name):
     if not chan_re.match(chan_name):
@@ -40,10 +43,16 @@ def join_chan(server, user, chan_name):
             others_only=True)
 
     send_topic(server, user, chan)
-    send_names(server, user, chan)
 
+    # the names of very large channels have to be asked for
+    limit = server.config.join_names_limit
+    if limit and server.chan_count(chan) > limit:
+        server.send_reply(user, 'RPL_ENDOFNAMES', chan['name'])
+    else:
+        send_names(server, user, chan)
 
-@command(auth=True, args=1)
+
+@command(auth=True, args=1, prefetch=True)
 def cmd_join(server, user, chanlist):
     chans = chanlist.split(',')
     for chan_name in chans:
@@ -61,13 +70,45 @@ def map_mode(mode):
     return symbol
 
 
-def send_names(server, user, chan):
-    nicks = []
-    for nick, data in server.chan_nicks(chan):
-        nicks.append('%s%s' % (map_mode(data['modes']), nick))
-    nick_list = ' '.join(nicks)
+def render_names(chan_nicks):
+    return ['%s%s' % (map_mode(data['modes']), nick)
+            for nick, data in chan_nicks]
+
+
+def split_names(names, width):
+    """
+    Join the names in lines of at most width characters
+    """
+    lines = []
+    line = []
+    length = -1
+    for name in names:
+        if line and length + 1 + len(name) > width:
+            lines.append(' '.join(line))
+            line = []
+            length = -1
+        line.append(name)
+        length += 1 + len(name)
+    if line:
+        lines.append(' '.join(line))
+    return lines
 
-    server.send_reply(user, 'RPL_NAMREPLY', chan['name'], nick_list)
+
+def send_names(server, user, chan):
+    """
+    Send the names of the channel members, in as many RPL_NAMREPLY lines as
+    needed to keep them under max_line_length
+    """
+    names, lines = server.chan_names(chan, render_names)
+
+    # the room left depends on the length of the nick
+    width = max_line_length - len(':%s 353 %s = %s :\r\n' % (
+        server.name, user['nick'], chan['name']))
+    if width not in lines:
+        lines[width] = split_names(names, width)
+
+    for line in lines[width]:
+        server.send_reply(user, 'RPL_NAMREPLY', chan['name'], line)
     server.send_reply(user, 'RPL_ENDOFNAMES', chan['name'])
 
 
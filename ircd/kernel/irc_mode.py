@@ -88,7 +88,7 @@ def mode_chan(server, user, target, args):
             server.send_reply(user, 'ERR_UNKNOWNMODE', c)
 
 
-@command(auth=True, args=1)
+@command(auth=True, args=1, prefetch=True)
 def cmd_mode(server, user, target, args):
     if target[0] == '#':
         mode_chan(server, user, target, args)
@@ -35,11 +35,11 @@ def send_message(kind, server, user, target, message):
         server.send_command(tags, user, kind, target, message)
 
 
-@command(auth=True, args=2)
+@command(auth=True, args=2, prefetch=True)
 def cmd_privmsg(server, user, target, message):
     send_message('PRIVMSG', server, user, target, message)
 
 
-@command(auth=True, args=2)
+@command(auth=True, args=2, prefetch=True)
 def cmd_notice(server, user, target, message):
     send_message('NOTICE', server, user, target, message)
@@ -1,10 +1,17 @@
 import collections
+import itertools
 import msgpack as json
 import logging
-import timeout
+import threading
+import time
+import acl
 import command
-import redis
+import cache
+import redisutil
 import replies
+import scripts
+import workers
+from ..common import envelope, sharding, timeout
 from ..common.util import split
 
 
@@ -12,105 +19,415 @@ def _prefix(tag):
     return tag.split(':', 1)[0]
 
 
+def _discard(sets, key, member):
+    """
+    Remove member from sets[key], dropping the entry when it becomes empty
+    like redis does with empty sets and hashes
+    """
+    members = sets.get(key)
+    if members is None:
+        return
+
+    if isinstance(members, dict):
+        members.pop(member, None)
+    else:
+        members.discard(member)
+
+    if not members:
+        del sets[key]
+
+
 class Kernel(object):
-    def __init__(self, config):
+    def __init__(self, config, shard=0):
         self.config = config
         self.running = True
-        self.message = None
         self.name = config.server_name
 
+        self.shard = shard
+        self.shards = config.kernel_shards
+        self.queue = sharding.kernel_queue(shard, self.shards)
+        # lanes of the queue, in priority order
+        self.queues = [sharding.kernel_queue(shard, self.shards, lane)
+                       for lane in sharding.lanes]
+
+        # command -> [messages processed, redis round trips]
+        self.round_trips = collections.defaultdict(lambda: [0, 0])
+
+        # lane -> [messages processed, total wait, max wait, max depth]
+        self.lane_stats = dict((lane, [0, 0.0, 0.0, 0])
+                               for lane in sharding.lanes)
+
+        # longest wait of the messages of the current batch, published after
+        # every batch for the servers
+        self.lag = 0.0
+
+        # guards the stats and the caches in worker pool mode
+        self.lock = threading.Lock()
+
+        # messages for the servers, collected per thread while a message is
+        # processed: prefix -> list of messages
+        self.local = threading.local()
+
+        # versions of the cached access lists and NAMES, taken from a single
+        # counter so that a channel that is forgotten and created again never
+        # gets the version of a stale cache entry
+        self.versions = itertools.count(1)
+
+        # chan name -> access list version, renewed on every change
+        self.access_versions = collections.defaultdict(int)
+        # chan name -> (access list version, compiled matcher)
+        self.access_matchers = {}
+        self.next_reap = 0
+        # the versions of destroyed channels are forgotten when the kernel
+        # learns of it, or by sweep_chans()
+        self.next_sweep = 0
+
+        # chan name -> NAMES version, renewed when a member joins or parts or
+        # its modes change
+        self.names_versions = collections.defaultdict(int)
+        # chan name -> (NAMES version, rendered names, {width: lines})
+        self.names_cache = {}
+
         command.load_commands()
-        self.redis = redis.StrictRedis(db=config.redis_db)
+        self.redis = redisutil.Redis(config.redis_db, config.pipeline)
+        self.redis.load_scripts(scripts.scripts)
+        self.index_access()
+
+        if config.streams:
+            self.mq = redisutil.StreamQueue(
+                self.redis, self.queues, 'kernel', config.stream_maxlen,
+                config.stream_max_deliveries)
+        else:
+            self.mq = redisutil.ListQueue(self.redis, self.queues)
+
+        # restarts are timed, they pause the processing of messages
+        start = time.time()
+        tags = self.connected_tags()
+        # servers that get the channel messages
+        self.prefixes = set(_prefix(tag) for tag in tags)
+        self.init_cache(config, tags)
+        self.init_timeout(config, tags)
+        logging.info('loaded %d users in %.3f seconds', len(tags),
+                     time.time() - start)
+
+        self.workers = None
+        if config.workers:
+            self.workers = workers.WorkerPool(
+                config.workers, self.process_message)
+
+    def connected_tags(self):
+        """
+        Return the tags of all connected users
 
-        self.init_timeout(config)
+        They are read from the server-users:* index sets, there are only as
+        many of these as there are servers.
+        """
+        keys = list(redisutil.scan(self.redis, 'server-users:*'))
+        pipe = self.redis.pipeline(False)
+        for key in keys:
+            pipe.smembers(key)
+
+        tags = set()
+        for members in pipe.execute():
+            tags.update(members)
+        return tags
 
-    def init_timeout(self, config):
+    def init_cache(self, config, tags):
         """
-        Initialize the timeout tracker
+        Initialize the write-through cache, if enabled
         """
+        self.cache = None
+        if config.cache and self.shards > 1:
+            logging.warning('the cache is not supported with multiple shards')
+        elif config.cache:
+            self.cache = cache.Cache()
+            self.cache.load(self.redis, tags)
+
+    def init_timeout(self, config, tags):
+        """
+        Initialize the timeout tracker, unless the servers keep the
+        connections alive themselves
+        """
+        self.timeout = None
+        if config.endpoint_keepalive:
+            return
+
         self.timeout = timeout.Timeout(self, config)
 
         # track all connected users
-        keys = self.redis.keys('user:*')
-        for key in keys:
-            tag = key.split(':', 1)[1]
-            self.timeout.update(tag)
+        for tag in tags:
+            if self.is_home(tag):
+                self.timeout.update(tag)
 
     def loop(self):
         """
         Infinite get message/process message loop
 
-        Messages are read from a redis list that works like a message queue.
+        Messages are read from a redis list (or stream) that works like a
+        message queue.
         """
-        logging.info('IRCd started')
+        logging.info('IRCd started (shard %d of %d)', self.shard, self.shards)
 
         while self.running:
-            self.timeout.check()
-            ret = self.redis.blpop('mq:kernel', 1)
-            if ret:
-                _, self.message = ret
-                self.process_message(self.message)
-                self.message = None
+            if self.timeout:
+                self.timeout.check()
+            self.reap_access()
+            self.sweep_chans()
+            self.redis.commit()
+
+            # stop() only ends the loop once the batch is processed
+            for message in self.read_messages():
+                if self.workers:
+                    self.dispatch(message)
+                else:
+                    self.process_message(message)
+
+            if self.workers:
+                self.workers.wait()
+                if self.config.cache_check:
+                    self.check_cache()
+
+            self.publish_lag()
+            self.mq.ack()
+            self.redis.commit()
+
+        logging.info('IRCd stopped')
+        self.log_round_trips()
+        self.log_lanes()
+
+    def classify(self, message):
+        """
+        Return the key that orders a message in worker pool mode
+
+        Messages with the same key are processed in order, messages with
+        different keys concurrently. Messages without a key (connect,
+        disconnect, registration and every other command that is not aimed
+        at a single channel or nick) are barriers: they are processed alone,
+        after everything before them and before everything after them.
+        """
+        fields = self.decode(message)
+        if fields is None or fields[0] != 'message':
+            return None
+
+        cmd, params = fields[2]
+        target = split(params[0], 1)[0]
+        if cmd not in sharding.chan_commands or not target or ',' in target:
+            return None
+
+        if target[0] == '#' or cmd in sharding.nick_commands:
+            return target
+
+        return None
+
+    def dispatch(self, message):
+        """
+        Hand a message over to the worker pool
+        """
+        key = self.classify(message)
+        if key is None:
+            self.workers.wait()
+            self.process_message(message)
+        else:
+            self.workers.put(key, message)
+
+    def publish_lag(self):
+        """
+        Tell the servers how long the messages of the last batch waited in
+        the queue
+
+        The servers stop reading from their users when the kernel falls too
+        far behind. The key expires, so a kernel that is gone does not keep
+        them paused.
+        """
+        self.redis.setex(sharding.lag_key(self.shard), 10, '%.3f' % self.lag)
+        self.lag = 0.0
+
+    def read_messages(self):
+        """
+        Read a batch of messages from the queue
+
+        Up to batch_size messages per lane are read in a single round trip,
+        the high priority ones first. If the queue is empty, block until a
+        message arrives (or a 1 second timeout).
+        """
+        messages = self.mq.read(self.config.batch_size)
+
+        for lane, depth in zip(sharding.lanes, self.mq.depths):
+            stats = self.lane_stats[lane]
+            stats[3] = max(stats[3], depth)
+
+        return messages
 
     def stop(self):
         """
         Stop the infinite loop
 
         This method can be called from a signal handler or from inside
-        process_message().
+        process_message(). The loop ends once the current batch is processed,
+        or after the blocking read of the queue times out.
         """
-
-        logging.info('IRCd stopped')
-
-        # exit the loop during the next iteration
         self.running = False
 
-        if not self.message:
-            # if a message is not being processed the process might be
-            # blocked in redis.blpop(), in this case just exit
-            import sys
-            sys.exit(0)
+    def decode(self, message):
+        """
+        Deserialize a message, or return None if it can't be read
+
+        A message the kernel can't read is dropped, like one of a server
+        running another envelope version, instead of stopping the loop.
+        """
+        try:
+            return envelope.loads(message)
+        except ValueError as e:
+            logging.error('dropping message %r: %s', message, e)
+            return None
 
     def process_message(self, message):
-        kind, origin, data = message.split(' ', 2)
+        fields = self.decode(message)
+        if fields is None:
+            return
+
+        kind, origin, data, sent = fields
+        round_trips = self.redis.round_trips
+
+        wait = time.time() - sent
+        with self.lock:
+            stats = self.lane_stats[sharding.lane_of(kind)]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            self.lag = max(self.lag, wait)
+
+        self.local.output = {}
+        try:
+            if kind == 'message':
+                self.user_message(origin, data)
+
+            elif kind == 'connect':
+                self.user_connect(origin, data)
+
+            elif kind == 'disconnect':
+                self.user_disconnect(origin, data)
+
+            elif kind == 'part':
+                self.user_part(origin, data)
 
-        if kind == 'message':
-            self.user_message(origin, data)
+            elif kind == 'reset':
+                self.server_reset(origin, data)
 
-        elif kind == 'connect':
-            self.user_connect(origin, data)
+            elif kind == 'shutdown':
+                self.stop()
 
-        elif kind == 'disconnect':
-            self.user_disconnect(origin, data)
+        finally:
+            self.flush_output()
+            # in pipelined mode this sends all the writes of this message
+            self.redis.commit()
 
-        elif kind == 'reset':
-            self.server_reset(origin, data)
+        name = data[0] if kind == 'message' else kind
+        with self.lock:
+            stats = self.round_trips[name]
+            stats[0] += 1
+            stats[1] += self.redis.round_trips - round_trips
+
+        # in worker pool mode the cache is checked after each batch
+        if self.config.cache_check and not self.workers:
+            self.check_cache()
+
+    def check_cache(self):
+        """
+        Make sure the cache has the same contents as redis
+        """
+        if not self.cache:
+            return
+
+        diffs = self.cache.diff(self.redis)
+        if diffs:
+            raise RuntimeError('cache out of sync: %s' % ' '.join(diffs))
+
+    def log_round_trips(self):
+        """
+        Log the average number of redis round trips per command
+        """
+        for name, (count, round_trips) in sorted(self.round_trips.items()):
+            logging.info('%s: %d messages, %.2f round trips/message',
+                         name, count, float(round_trips) / count)
+
+    def log_lanes(self):
+        """
+        Log how long messages waited in each lane of the queue and how many
+        were left behind at most
+        """
+        for lane in sharding.lanes:
+            count, wait, max_wait, max_depth = self.lane_stats[lane]
+            if count:
+                logging.info('%s lane: %d messages, %.3fs average wait, '
+                             '%.3fs max wait, %s max depth', lane, count,
+                             wait / count, max_wait, max_depth)
+
+    def is_home(self, tag):
+        """
+        Whether this shard is the home shard of the user, which handles its
+        connection, registration and ping timeout
+        """
+        return sharding.shard_of(tag, self.shards) == self.shard
+
+    def enqueue(self, shard, kind, origin, data):
+        """
+        Send a message to the queue of another kernel shard
+        """
+        lane = sharding.lane_of(kind)
+        message = envelope.message(kind, origin, data)
+        self.mq.push(message, sharding.kernel_queue(shard, self.shards, lane))
+
+    def forward(self, tag, user, cmd, params):
+        """
+        Forward the parts of a user command owned by other shards
+
+        Returns the parameters left for this shard, if any. Messages of users
+        who are not registered yet are always handled by their home shard,
+        which forwards them again if the user is registered by then.
+        """
+        if not user or 'auth' not in user:
+            if self.is_home(tag):
+                return params
 
-        elif kind == 'shutdown':
-            self.stop()
+            home = sharding.shard_of(tag, self.shards)
+            self.enqueue(home, 'message', tag, [cmd, params])
+            return None
 
-    def user_message(self, tag, message):
-        logging.debug('message %s %s', tag, message)
+        local = None
+        for shard, part in sharding.route(tag, cmd, params, self.shards):
+            if shard == self.shard:
+                local = part
+            else:
+                self.enqueue(shard, 'message', tag, [cmd, part])
 
-        self.timeout.update(tag)
+        return local
+
+    def user_message(self, tag, data):
+        cmd, params = data
+        logging.debug('message %s %s %r', tag, cmd, params)
+
+        if self.timeout and self.is_home(tag):
+            self.timeout.update(tag)
 
         user = self.load_user(tag)
+        if self.shards > 1:
+            params = self.forward(tag, user, cmd, params)
+            if params is None:
+                return
+
         if not user:
             logging.error('user %s not found' % tag)
             return
 
-        try:
-            message.decode('utf-8')
-        except:
-            self.send_reply(user, 'ERR_NONUTF8')
-            return
-
-        command.dispatch(self, user, message)
+        # the servers already checked the encoding and tokenized the line
+        command.dispatch(self, user, cmd, params)
 
     def user_connect(self, tag, address):
         logging.debug('connect %s %s', tag, address)
 
-        self.timeout.update(tag)
+        if self.timeout:
+            self.timeout.update(tag)
 
         user = {
             'ip': address,
@@ -121,41 +438,190 @@ class Kernel(object):
 
         prefix = _prefix(tag)
         self.redis.sadd('server-users:' + prefix, tag)
+        self.prefixes.add(prefix)
 
     def user_disconnect(self, tag, reason):
         logging.debug('disconnect %s %s', tag, reason)
 
-        self.timeout.remove(tag)
+        if self.timeout:
+            self.timeout.remove(tag)
 
         user = self.load_user(tag)
         if not user:
             logging.error('user %s not found' % tag)
             return
 
-        chans = self.user_chans(user)
-        for chan_name in chans:
-            command.dispatch(self, user, 'PART %s' % chan_name)
+        # the joins other shards run from now on find the user gone, the
+        # ones that ran before are in its channels
+        self.redis.delete('user:' + tag)
 
-        if 'auth' in user:
-            self.unregister_nick(user)
+        # channels owned by other shards are parted by them
+        chans = []
+        others = collections.defaultdict(list)
+        for chan_name in self.user_chans(user):
+            shard = sharding.shard_of(chan_name, self.shards)
+            if shard == self.shard:
+                chans.append(chan_name)
+            else:
+                others[shard].append(chan_name)
 
-        self.redis.delete('user:' + tag)
+        for shard, chan_names in others.iteritems():
+            data = {'user': user, 'chans': chan_names}
+            self.enqueue(shard, 'part', tag, data)
 
-        prefix = _prefix(tag)
-        self.redis.srem('server-users:' + prefix, tag)
+        # one QUIT for every user that shares channels with this one
+        tags = self.visible_tags(user)
+        tags.discard(tag)
+        if tags:
+            self.send(tags, ':%s QUIT :%s' % (user['id'], reason))
+
+        self.delete_user(user, chans)
+
+    def user_part(self, tag, data):
+        """
+        Part a disconnected user from channels owned by this shard, on behalf
+        of the user's home shard
+
+        The home shard already sent the QUIT to the other members.
+        """
+        user = data['user']
+
+        for chan_name in data['chans']:
+            chan = self.find_chan(chan_name)
+            if chan and self.user_in_chan(user, chan):
+                self.part_chan(user, chan)
 
     def server_reset(self, prefix, reason):
+        """
+        Disconnect all the users of a server that restarted
+
+        Unlike user_disconnect, the users are read and deleted in pipelined
+        batches, and every remaining user gets a single message with the
+        QUITs of all its peers that are gone.
+        """
         logging.debug('reset %s %s', prefix, reason)
+        start = time.time()
+
+        # the users of other shards are gone too, they don't get QUITs
+        gone = self.redis.smembers('server-users:' + prefix)
+        tags = [tag for tag in gone if self.is_home(tag)]
+        users = self.load_users(tags)
+
+        if self.timeout:
+            for tag in tags:
+                self.timeout.remove(tag)
+
+        # channels owned by other shards are parted by them
+        for user, chans in users:
+            others = collections.defaultdict(list)
+            for chan_name in chans:
+                shard = sharding.shard_of(chan_name, self.shards)
+                if shard != self.shard:
+                    others[shard].append(chan_name)
+            for shard, chan_names in others.iteritems():
+                data = {'user': user, 'chans': chan_names}
+                self.enqueue(shard, 'part', user['tag'], data)
+
+        # remaining user -> QUITs of its peers
+        quits = collections.defaultdict(list)
+        chan_names = set()
+        for user, chans in users:
+            chan_names.update(chans)
+        members = self.load_chan_users(chan_names)
+        for user, chans in users:
+            line = ':%s QUIT :%s' % (user['id'], reason)
+            peers = set()
+            for chan_name in chans:
+                peers.update(members[chan_name])
+            for tag in peers - gone:
+                quits[tag].append(line)
+
+        # users with the same peers gone get the same message
+        recipients = collections.defaultdict(list)
+        for tag, lines in quits.iteritems():
+            recipients['\r\n'.join(lines)].append(tag)
+        for message, tags in recipients.iteritems():
+            self.send(tags, message)
+
+        self.redis.load_scripts([scripts.disconnect])
+        for batch in redisutil.batches(users):
+            pipe = self.redis.pipeline(False)
+            for user, chans in batch:
+                local = [chan_name for chan_name in chans
+                         if sharding.shard_of(chan_name, self.shards) ==
+                         self.shard]
+                self.delete_user(user, local, pipe)
+            for destroyed in pipe.execute():
+                self.forget_chans(destroyed)
+
+        # the server comes back with a new connect, or doesn't come back
+        self.prefixes.discard(prefix)
+
+        logging.info('reset %s: %d users in %.3f seconds', prefix, len(tags),
+                     time.time() - start)
+
+    def load_users(self, tags):
+        """
+        Read the users with the given tags and their channels, in pipelined
+        batches
 
-        tags = self.redis.smembers('server-users:' + prefix)
-        for tag in tags:
-            self.user_disconnect(tag, reason)
+        Returns a list of (user, channel names), users that are not found
+        are left out. The users are deleted before their channels are read,
+        so the joins other shards run afterwards find them gone.
+        """
+        if self.cache:
+            users = [(self.load_user(tag), self.user_chans({'tag': tag}))
+                     for tag in tags]
+            return [(user, chans) for user, chans in users if user]
+
+        users = []
+        for batch in redisutil.batches(tags):
+            pipe = self.redis.pipeline(False)
+            for tag in batch:
+                pipe.get('user:' + tag)
+                pipe.delete('user:' + tag)
+                pipe.smembers('user-chans:' + tag)
+            results = pipe.execute()
+
+            for i in range(len(batch)):
+                serialized, _, chans = results[3 * i:3 * i + 3]
+                if serialized:
+                    users.append((json.loads(serialized), chans))
+        return users
+
+    def load_chan_users(self, chan_names):
+        """
+        Read the members of the given channels, in pipelined batches
+
+        Returns a dict of chan name -> tags.
+        """
+        if self.cache:
+            return dict((chan_name, self.chan_users(chan_name))
+                        for chan_name in chan_names)
+
+        members = {}
+        for batch in redisutil.batches(list(chan_names)):
+            pipe = self.redis.pipeline(False)
+            for chan_name in batch:
+                pipe.smembers('chan-users:' + chan_name)
+            members.update(zip(batch, pipe.execute()))
+        return members
 
     def send_chan(self, user, command, chan, args='', others_only=False):
-        tags = self.redis.smembers('chan-users:' + chan['name'])
-        if others_only:
-            tags.discard(user['tag'])
-        self.send_command(tags, user, command, chan['name'], args)
+        """
+        Send a message to the members of a channel
+
+        The servers keep the channel members among their users, so the
+        message does not list them and its size doesn't depend on the size
+        of the channel.
+        """
+        message = ':%s %s %s %s' % (user['id'], command, chan['name'], args)
+        skip = user['tag'] if others_only else ''
+        logging.debug('send %s %s' % (chan['name'], message))
+
+        line = message.strip() + '\r\n'
+        for prefix in list(self.prefixes):
+            self.push(prefix, ['chan', chan['name'], skip, line])
 
     def send_command(self, tags, source, command, target, args):
         self.send(tags, ':%s %s %s %s' % (source['id'], command, target, args))
@@ -168,42 +634,138 @@ class Kernel(object):
     def send_visible(self, user, reply, *args):
         numeric, format = replies.replies.get(reply, (reply, '%s'))
         message = ':%s %s %s' % (user['id'], numeric, format % args)
-        tags = set()
-        for chan_name in self.user_chans(user):
-            chan_tags = self.redis.smembers('chan-users:' + chan_name)
-            tags.update(chan_tags)
+        tags = self.visible_tags(user)
         tags.discard(user['tag'])
         self.send(tags, message)
 
+    def visible_tags(self, user):
+        """
+        Tags of the members of all the channels of the user, the user
+        included, read in a single round trip
+        """
+        if self.cache:
+            tags = set()
+            for chan_name in self.cache.user_chans.get(user['tag'], ()):
+                tags.update(self.cache.chan_users.get(chan_name, ()))
+            return tags
+
+        keys = ['user-chans:' + user['tag']]
+        return set(self.redis.script(scripts.visible, keys, []))
+
     def send(self, tags, message):
         message = message.strip()
         logging.debug('send %s' % message)
 
         if type(tags) in [str, unicode]:
-            prefix = _prefix(tags)
-            self.redis.rpush('mq:' + prefix, '%s %s\r\n' % (tags, message))
-            return
+            tags = [tags]
 
         prefixes = collections.defaultdict(list)
         for tag in tags:
             prefixes[_prefix(tag)].append(tag)
 
+        line = message + '\r\n'
         for prefix, tags in prefixes.iteritems():
-            tags = ','.join(tags)
-            self.redis.rpush('mq:' + prefix, '%s %s\r\n' % (tags, message))
+            self.push(prefix, [tags, line])
 
     def disconnect(self, user):
         tag = user['tag']
-        self.redis.rpush('mq:' + _prefix(tag), '%s ' % tag)
+        self.push(_prefix(tag), [[tag], ''])
+
+    def push(self, prefix, fields):
+        """
+        Send a message to a server
+
+        While a message is being processed, the messages for each server are
+        collected and sent together by flush_output(). Consecutive lines to
+        the same tags are joined.
+        """
+        output = getattr(self.local, 'output', None)
+        if output is None:
+            self.redis.rpush('mq:' + prefix, envelope.dumps(*fields))
+            return
+
+        messages = output.setdefault(prefix, [])
+        if messages:
+            last = messages[-1]
+            # an empty line closes the connection, it is never joined
+            if isinstance(fields[0], list) and last[0] == fields[0] and \
+                    last[1] and fields[1]:
+                last[1] += fields[1]
+                return
+        messages.append(fields)
+
+    def flush_output(self):
+        """
+        Send the messages collected for each server in a single push, as a
+        batch if there are several
+        """
+        output, self.local.output = self.local.output, None
+        for prefix, messages in output.iteritems():
+            if len(messages) == 1:
+                message = envelope.dumps(*messages[0])
+            else:
+                message = envelope.dumps('batch', messages)
+            self.redis.rpush('mq:' + prefix, message)
 
     def load_user(self, tag):
+        if self.cache:
+            user = self.cache.users.get(tag)
+            return user and dict(user)
+
         serialized = self.redis.get('user:' + tag)
         return serialized and json.loads(serialized)
 
     def save_user(self, user):
+        if self.cache:
+            self.cache.users[user['tag']] = dict(user)
+
         serialized = json.dumps(user)
         self.redis.set('user:' + user['tag'], serialized)
 
+    def delete_user(self, user, chans, pipe=None):
+        """
+        Remove the user from the given channels, unregister its nick and
+        delete it
+
+        If a pipeline is given, the deletion is queued in it, and its result
+        is the list of channels that were destroyed.
+        """
+        tag = user['tag']
+
+        if self.cache:
+            with self.lock:
+                c = self.cache
+                c.user_chans.pop(tag, None)
+                for chan_name in chans:
+                    _discard(c.chan_nicks, chan_name, user['nick'])
+                    _discard(c.chan_users, chan_name, tag)
+                    if chan_name not in c.chan_nicks:
+                        c.chans.pop(chan_name, None)
+                c.users.pop(tag, None)
+
+        for chan_name in chans:
+            self.names_changed(chan_name)
+
+        keys = [
+            'user:' + tag,
+            'user-chans:' + tag,
+            'server-users:' + _prefix(tag),
+            'nick-users:' + user['nick'],
+            'access-expiry'
+        ]
+        for chan_name in chans:
+            keys.extend(['chan-nicks:' + chan_name, 'chan-users:' + chan_name,
+                         'chan-access:' + chan_name, 'chan:' + chan_name])
+        args = [tag, user['nick']] + list(chans)
+        if pipe is None:
+            destroyed = self.redis.script(scripts.disconnect, keys, args,
+                                          write=True)
+            # None when buffered
+            self.forget_chans(destroyed or [])
+        else:
+            pipe.execute_command('EVALSHA', scripts.disconnect.sha,
+                                 len(keys), *(keys + args))
+
     def find_or_create_chan(self, chan_name):
         chan = self.find_chan(chan_name)
         if chan:
@@ -217,77 +779,368 @@ class Kernel(object):
         self.save_chan(chan)
         return chan, True
 
+    def prefetch_chans(self, user, chan_names):
+        """
+        Fetch the channel data needed by most channel commands in a single
+        round trip
+
+        Only done in pipelined mode, the results are kept until the end of
+        the current message.
+        """
+        if not self.redis.buffered or self.cache:
+            return
+
+        commands = []
+        for chan_name in chan_names:
+            if chan_name[0:1] != '#':
+                continue
+
+            commands.append(('GET', 'chan:' + chan_name))
+            commands.append(('HGET', 'chan-nicks:' + chan_name, user['nick']))
+            commands.append(
+                ('SISMEMBER', 'chan-users:' + chan_name, user['tag']))
+
+        if commands:
+            self.redis.prefetch(commands)
+
     def find_chan(self, chan_name):
+        if self.cache:
+            chan = self.cache.chans.get(chan_name)
+            return chan and dict(chan)
+
         chan = self.redis.get('chan:' + chan_name)
         return chan and json.loads(chan)
 
     def save_chan(self, chan):
+        if self.cache:
+            self.cache.chans[chan['name']] = dict(chan)
+
         serialized = json.dumps(chan)
         chan = self.redis.set('chan:' + chan['name'], serialized)
 
     def join_chan(self, user, chan, data):
-        self.set_chan_nick(chan, user['nick'], data)
-        self.redis.sadd('chan-users:' + chan['name'], user['tag'])
-        self.redis.sadd('user-chans:' + user['tag'], chan['name'])
+        name, nick, tag = chan['name'], user['nick'], user['tag']
+
+        if self.cache:
+            with self.lock:
+                c = self.cache
+                c.chan_nicks.setdefault(name, {})[nick] = dict(data)
+                c.chan_users.setdefault(name, set()).add(tag)
+                c.user_chans.setdefault(tag, set()).add(name)
+
+        keys = [
+            'chan-nicks:' + name,
+            'chan-users:' + name,
+            'user-chans:' + tag,
+            'user:' + tag,
+            'chan-access:' + name,
+            'chan:' + name,
+            'access-expiry'
+        ]
+        args = [nick, json.dumps(data), tag, name]
+        self.redis.script(scripts.join, keys, args, write=True)
+        self.names_changed(name)
+
+        # tell the server of the user
+        prefix = _prefix(tag)
+        self.prefixes.add(prefix)
+        self.push(prefix, ['join', name, tag])
 
     def part_chan(self, user, chan):
-        self.redis.hdel('chan-nicks:' + chan['name'], user['nick'])
-        self.redis.srem('chan-users:' + chan['name'], user['tag'])
-        self.redis.srem('user-chans:' + user['tag'], chan['name'])
-
-        if not self.chan_count(chan):
-            self.destroy_chan(chan)
+        """
+        Remove the user from the channel, destroying the channel if it ends up
+        empty
+        """
+        name, nick, tag = chan['name'], user['nick'], user['tag']
+
+        if self.cache:
+            with self.lock:
+                c = self.cache
+                _discard(c.chan_nicks, name, nick)
+                _discard(c.chan_users, name, tag)
+                _discard(c.user_chans, tag, name)
+                if name not in c.chan_nicks:
+                    c.chans.pop(name, None)
+
+        keys = [
+            'chan-nicks:' + name,
+            'chan-users:' + name,
+            'user-chans:' + tag,
+            'chan-access:' + name,
+            'chan:' + name,
+            'access-expiry'
+        ]
+        destroyed = self.redis.script(scripts.part, keys, [nick, tag, name],
+                                      write=True)
+        self.names_changed(name)
+        if destroyed:
+            self.forget_chans([name])
+        self.push(_prefix(tag), ['part', name, tag])
 
     def nick_in_chan(self, user, chan):
+        if self.cache:
+            return user['nick'] in self.cache.chan_nicks.get(chan['name'], {})
+
         return self.redis.hexists('chan-nicks:' + chan['name'], user['nick'])
 
     def user_in_chan(self, user, chan):
+        if self.cache:
+            return user['tag'] in self.cache.chan_users.get(chan['name'], ())
+
         return self.redis.sismember('chan-users:' + chan['name'], user['tag'])
 
     def user_chans(self, user):
+        if self.cache:
+            return set(self.cache.user_chans.get(user['tag'], ()))
+
         return self.redis.smembers('user-chans:' + user['tag'])
 
+    def chan_users(self, chan_name):
+        if self.cache:
+            return set(self.cache.chan_users.get(chan_name, ()))
+
+        return self.redis.smembers('chan-users:' + chan_name)
+
     def chan_count(self, chan):
+        if self.cache:
+            return len(self.cache.chan_nicks.get(chan['name'], ()))
+
         return self.redis.hlen('chan-nicks:' + chan['name'])
 
     def chan_nicks(self, chan):
+        if self.cache:
+            nicks = self.cache.chan_nicks.get(chan['name'], {})
+            return [(nick, dict(data)) for nick, data in nicks.iteritems()]
+
         nicks = self.redis.hgetall('chan-nicks:' + chan['name'])
         return [(nick, json.loads(data)) for nick, data in nicks.iteritems()]
 
     def chan_nick(self, chan, nick):
+        if self.cache:
+            data = self.cache.chan_nicks.get(chan['name'], {}).get(nick)
+            return data and dict(data)
+
         serialized = self.redis.hget('chan-nicks:' + chan['name'], nick)
         return serialized and json.loads(serialized)
 
     def set_chan_nick(self, chan, nick, data):
+        if self.cache:
+            with self.lock:
+                nicks = self.cache.chan_nicks.setdefault(chan['name'], {})
+                nicks[nick] = dict(data)
+
         serialized = json.dumps(data)
         self.redis.hset('chan-nicks:' + chan['name'], nick, serialized)
+        self.names_changed(chan['name'])
+
+    def names_changed(self, chan_name):
+        """
+        Invalidate the rendered NAMES of a channel
+        """
+        with self.lock:
+            self.names_versions[chan_name] = next(self.versions)
+            self.names_cache.pop(chan_name, None)
+
+    def chan_names(self, chan, render):
+        """
+        Return the NAMES of a channel, as rendered by render(chan_nicks), and
+        a dict to cache their lines in
 
-    def destroy_chan(self, chan):
-        self.redis.delete('chan-access:' + chan['name'])
-        self.redis.delete('chan:' + chan['name'])
+        Both are cached until the channel members or their modes change.
+        """
+        name = chan['name']
+        version = self.names_versions[name]
+        cached = self.names_cache.get(name)
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+
+        names = render(self.chan_nicks(chan))
+        lines = {}
+        with self.lock:
+            if self.names_versions[name] == version:
+                self.names_cache[name] = (version, names, lines)
+        return names, lines
 
     def register_nick(self, user):
         self.redis.sadd('nick-users:' + user['nick'], user['tag'])
 
-    def unregister_nick(self, user):
-        self.redis.srem('nick-users:' + user['nick'], user['tag'])
-
     def find_nick(self, nick):
         return self.redis.smembers('nick-users:' + nick)
 
     def access_list_all(self, chan):
-        acl_dict = self.redis.hgetall('chan-access:' + chan['name'])
-        for key, value in acl_dict.iteritems():
+        """
+        Iterate over the access list entries
+
+        Expired entries are deleted by reap_access(), the ones it didn't get
+        to yet are skipped.
+        """
+        now = time.time()
+        entries = self.redis.hgetall('chan-access:' + chan['name'])
+        for key, value in entries.iteritems():
             level, mask = key.split()
             timeout, user, reason = split(value, 2)
             timeout = int(timeout)
+            if 0 < timeout < now:
+                continue
             yield (level, mask, timeout, user, reason)
 
     def access_list_add(self, chan, level, mask, timeout, user, reason):
+        self.access_list_changed(chan)
+
         key = '%s %s' % (level, mask)
         value = '%d %s %s' % (timeout, user['id'], reason)
         self.redis.hset('chan-access:' + chan['name'], key, value)
 
+        # timed entries are indexed by their timeout for reap_access()
+        member = '%s %s' % (chan['name'], key)
+        if timeout > 0:
+            self.redis.zadd('access-expiry', timeout, member)
+        else:
+            self.redis.zrem('access-expiry', member)
+
     def access_list_del(self, chan, level, mask):
-        key = '%s %s' % (level, mask)
-        self.redis.hdel('chan-access:' + chan['name'], key)
+        self.access_list_del_many(chan, [(level, mask)])
+
+    def access_list_del_many(self, chan, entries):
+        keys = ['%s %s' % (level, mask) for level, mask in entries]
+        if keys:
+            self.access_list_changed(chan)
+            self.redis.hdel('chan-access:' + chan['name'], *keys)
+            members = ['%s %s' % (chan['name'], key) for key in keys]
+            self.redis.zrem('access-expiry', *members)
+
+    def index_access(self):
+        """
+        Bring access-expiry up to date with the access lists, only once
+
+        Timed entries created before access-expiry existed are added to it,
+        and the members left behind by destroyed channels are removed.
+        """
+        if not self.redis.setnx('access-expiry-indexed', 1):
+            return
+
+        start = time.time()
+        keys = list(redisutil.scan(self.redis, 'chan-access:*'))
+        added = 0
+        for batch in redisutil.batches(keys):
+            pipe = self.redis.pipeline(False)
+            for key in batch:
+                pipe.hgetall(key)
+            results = pipe.execute()
+
+            pipe = self.redis.pipeline(False)
+            for key, entries in zip(batch, results):
+                chan_name = key.split(':', 1)[1]
+                for entry, value in entries.iteritems():
+                    timeout = int(value.split(' ', 1)[0])
+                    if timeout > 0:
+                        member = '%s %s' % (chan_name, entry)
+                        pipe.zadd('access-expiry', timeout, member)
+                        added += 1
+            pipe.execute()
+
+        members = self.redis.zrange('access-expiry', 0, -1)
+        removed = 0
+        for batch in redisutil.batches(members):
+            pipe = self.redis.pipeline(False)
+            for member in batch:
+                chan_name, entry = member.split(' ', 1)
+                pipe.hexists('chan-access:' + chan_name, entry)
+            stale = [member for member, exists in zip(batch, pipe.execute())
+                     if not exists]
+            if stale:
+                self.redis.zrem('access-expiry', *stale)
+                removed += len(stale)
+        self.redis.flush()
+
+        logging.info('indexed %d timed access entries and removed %d stale '
+                     'ones in %.3f seconds', added, removed,
+                     time.time() - start)
+
+    def reap_access(self):
+        """
+        Delete the timed access list entries that expired
+
+        Runs every access_reap_interval seconds, or again on the next
+        iteration of the loop if there were too many expired entries.
+        """
+        now = time.time()
+        if now < self.next_reap:
+            return
+
+        limit = 1000
+        due = self.redis.script(scripts.access_expire, ['access-expiry'],
+                                [now, limit])
+        for member in due:
+            self.access_list_changed({'name': member.split(' ', 1)[0]})
+
+        if len(due) < limit:
+            self.next_reap = now + self.config.access_reap_interval
+
+    def access_list_changed(self, chan):
+        """
+        Invalidate the compiled access list of a channel
+
+        A channel that is destroyed loses its access list, but it gets an
+        OWNER entry as soon as it is created again, so its matcher is
+        invalidated then.
+        """
+        with self.lock:
+            self.access_versions[chan['name']] = next(self.versions)
+
+    def forget_chans(self, chan_names):
+        """
+        Drop the cached access lists and NAMES of destroyed channels, with
+        their versions
+        """
+        with self.lock:
+            for chan_name in chan_names:
+                self.access_versions.pop(chan_name, None)
+                self.access_matchers.pop(chan_name, None)
+                self.names_versions.pop(chan_name, None)
+                self.names_cache.pop(chan_name, None)
+
+    def sweep_chans(self):
+        """
+        Forget the channels that were destroyed without the kernel learning
+        of it
+
+        Scripts buffered in pipelined mode don't report the channels they
+        destroy, so every access_reap_interval seconds the channels with
+        cached versions are checked.
+        """
+        now = time.time()
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.config.access_reap_interval
+
+        with self.lock:
+            chan_names = list(set(self.access_versions) |
+                              set(self.names_versions))
+
+        gone = []
+        for batch in redisutil.batches(chan_names):
+            pipe = self.redis.pipeline(False)
+            for chan_name in batch:
+                pipe.exists('chan:' + chan_name)
+            gone.extend(chan_name for chan_name, exists
+                        in zip(batch, pipe.execute()) if not exists)
+        self.forget_chans(gone)
+
+    def access_matcher(self, chan):
+        """
+        Return the compiled access list of a channel
+
+        Matchers are cached until the access list changes or one of its
+        entries expires.
+        """
+        name = chan['name']
+        version = self.access_versions[name]
+        cached = self.access_matchers.get(name)
+        if cached and cached[0] == version and not cached[1].expired():
+            return cached[1]
+
+        matcher = acl.Matcher(self.access_list_all(chan))
+        with self.lock:
+            self.access_matchers[name] = (version, matcher)
+        return matcher
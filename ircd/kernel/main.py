@@ -3,9 +3,9 @@ import logging
 import kernel
 
 
-def main(config):
+def main(config, shard=0):
     logging.getLogger().setLevel(logging.DEBUG)
-    server = kernel.Kernel(config)
+    server = kernel.Kernel(config, shard)
 
     def sig_handler(sig, frame):
         server.stop()
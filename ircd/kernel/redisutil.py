@@ -0,0 +1,385 @@
+import copy
+import logging
+import threading
+import redis
+from redis.client import StrictPipeline
+from redis.exceptions import NoScriptError, ResponseError
+
+# commands that only change state and whose replies are never used by the
+# kernel, these can be buffered in a pipeline
+write_commands = frozenset([
+    'SET', 'SETEX', 'DEL', 'SADD', 'SREM', 'HSET', 'HDEL', 'HMSET', 'RPUSH',
+    'LPUSH', 'LTRIM', 'EXPIRE', 'INCR', 'ZADD', 'ZREM', 'XADD', 'XACK'
+])
+
+_missing = object()
+
+
+def scan(redis, pattern, count=1000):
+    """
+    Iterate over the keys that match a pattern
+
+    Uses SCAN, which walks the keyspace in small steps instead of blocking
+    redis for the whole walk like KEYS.
+    """
+    cursor = '0'
+    while True:
+        cursor, keys = redis.execute_command('SCAN', cursor, 'MATCH', pattern,
+                                             'COUNT', count)
+        for key in keys:
+            yield key
+        if cursor == '0':
+            break
+
+
+def batches(items, size=1000):
+    """
+    Split a list into lists of at most size items
+    """
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _keys(args):
+    if args[0] == 'DEL':
+        return args[1:]
+    return args[1:2]
+
+
+class Pipeline(StrictPipeline):
+    """
+    A pipeline that counts its round trips in the Redis object that created it
+    """
+    def __init__(self, owner, *args):
+        super(Pipeline, self).__init__(*args)
+        self.owner = owner
+
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            self.owner.local.round_trips += 1
+        return super(Pipeline, self).execute(raise_on_error)
+
+
+class _Local(threading.local):
+    """
+    Buffering state, kept per thread so that threads can share a client
+    """
+    def __init__(self):
+        self.pipe = None
+        self.prefetched = {}
+        self.round_trips = 0
+
+
+class Redis(redis.StrictRedis):
+    """
+    StrictRedis with round trip accounting and optional write buffering
+
+    When buffered, write commands are queued in a pipeline that is only sent
+    to redis, as a single transaction, when flush() is called. Any other
+    command flushes the pipeline before executing, so reads always see the
+    writes that preceded them.
+
+    Reads can be issued ahead of time with prefetch(). Their results are
+    served from memory until a write touches the same key or commit() is
+    called.
+
+    Lua scripts are called by SHA with script(). Scripts whose results are
+    not needed are buffered like write commands, with their source, so that
+    redis losing its script cache can't reorder the buffered writes.
+
+    Buffered writes, prefetched results and round trip counts are per
+    thread.
+    """
+    def __init__(self, db, buffered=False):
+        super(Redis, self).__init__(db=db)
+        self.buffered = buffered
+        self.local = _Local()
+        # sha -> script
+        self.scripts = {}
+
+    @property
+    def round_trips(self):
+        return self.local.round_trips
+
+    def execute_command(self, *args, **options):
+        prefetched = self.local.prefetched
+
+        if args[0] in write_commands:
+            for key in _keys(args):
+                prefetched.pop(key, None)
+
+            if self.buffered:
+                self._buffer(args, options)
+                return None
+
+        elif len(args) > 1 and args[1] in prefetched:
+            result = prefetched[args[1]].get(args, _missing)
+            if result is not _missing:
+                return copy.copy(result)
+
+        self.flush()
+        self.local.round_trips += 1
+        return super(Redis, self).execute_command(*args, **options)
+
+    def _buffer(self, args, options=None):
+        if self.local.pipe is None:
+            # MULTI/EXEC makes redis-py report errors per command instead of
+            # raising on the first one
+            self.local.pipe = self._pipeline(True)
+        self.local.pipe.execute_command(*args, **(options or {}))
+
+    def _pipeline(self, transaction):
+        return Pipeline(self, self.connection_pool, self.response_callbacks,
+                        transaction, None)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        self.flush()
+        return self._pipeline(transaction)
+
+    def prefetch(self, commands):
+        """
+        Execute several read commands in a single round trip and keep their
+        results for later calls with the exact same arguments
+        """
+        pipe = self.pipeline(False)
+        for args in commands:
+            pipe.execute_command(*args)
+
+        prefetched = self.local.prefetched
+        for args, result in zip(commands, pipe.execute()):
+            prefetched.setdefault(args[1], {})[tuple(args)] = result
+
+    def load_scripts(self, scripts):
+        """
+        Load lua scripts into redis with SCRIPT LOAD
+
+        The scripts pass the keys they touch in KEYS, except the visible and
+        access_expire scripts, which read key names from other keys. These
+        need all the keys on a single redis instance, not a cluster or an
+        instance whose ACLs restrict the keys of the kernel.
+        """
+        pipe = self.pipeline(False)
+        for script in scripts:
+            self.scripts[script.sha] = script
+            pipe.script_load(script.source)
+        pipe.execute()
+
+    def script(self, script, keys, args, write=False):
+        """
+        Run a lua script by its SHA
+
+        If write is True, the script is buffered in pipelined mode and its
+        result is discarded.
+        """
+        self.scripts[script.sha] = script
+        command = (len(keys),) + tuple(keys) + tuple(args)
+
+        if write:
+            for key in keys:
+                self.local.prefetched.pop(key, None)
+
+            if self.buffered:
+                # EVAL runs in place even if redis forgot the script, redis
+                # caches it again by its SHA
+                self._buffer(('EVAL', script.source) + command)
+                return None
+
+        command = ('EVALSHA', script.sha) + command
+
+        try:
+            return self.execute_command(*command)
+        except NoScriptError:
+            # redis was restarted or flushed its script cache
+            self.load_scripts([script])
+            return self.execute_command(*command)
+
+    def flush(self):
+        """
+        Send all buffered writes
+        """
+        pipe = self.local.pipe
+        if pipe is None or not pipe.command_stack:
+            return
+
+        results = pipe.execute(raise_on_error=False)
+        for result in results:
+            if isinstance(result, ResponseError):
+                raise result
+
+    def commit(self):
+        """
+        Send all buffered writes and forget prefetched results
+
+        Called once at the end of every processed message.
+        """
+        self.flush()
+        self.local.prefetched.clear()
+
+
+class ListQueue(object):
+    """
+    A message queue on redis lists, one per lane
+
+    Messages are removed from the lists as soon as they are read. Lanes are
+    given in priority order.
+    """
+    def __init__(self, redis, names):
+        self.redis = redis
+        self.names = names
+        # number of messages left in each lane after the last read
+        self.depths = [0] * len(names)
+
+    def read(self, size):
+        """
+        Read up to size messages from each lane in a single round trip, those
+        of the first lanes first
+
+        If the queue is empty, block until a message arrives (or a 1 second
+        timeout).
+        """
+        pipe = self.redis.pipeline()
+        for name in self.names:
+            pipe.lrange(name, 0, size - 1)
+            pipe.ltrim(name, size, -1)
+            pipe.llen(name)
+        results = pipe.execute()
+
+        messages = []
+        for i in range(len(self.names)):
+            messages.extend(results[i * 3])
+            self.depths[i] = results[i * 3 + 2]
+        if messages:
+            return messages
+
+        ret = self.redis.blpop(self.names, 1)
+        return [ret[1]] if ret else []
+
+    def ack(self):
+        pass
+
+    def push(self, message, name):
+        """
+        Append a message to a queue of the same kind
+        """
+        self.redis.rpush(name, message)
+
+
+class StreamQueue(object):
+    """
+    A message queue on redis streams, one per lane, read through a consumer
+    group
+
+    Read messages stay in the group's pending entries list until ack() is
+    called, so a kernel that dies in the middle of a batch reads the
+    unacknowledged messages again when it restarts. A message delivered more
+    than max_deliveries times is moved to the <stream>:dead stream instead,
+    so one that crashes the kernel doesn't keep it from starting. Producers
+    trim the streams to about maxlen entries.
+
+    The depth of the lanes is not tracked.
+    """
+    group = 'kernel'
+
+    def __init__(self, redis, names, consumer, maxlen, max_deliveries):
+        self.redis = redis
+        self.names = names
+        self.consumer = consumer
+        self.maxlen = maxlen
+        self.max_deliveries = max_deliveries
+        self.depths = [None] * len(names)
+        # stream -> ids of the messages read but not acknowledged yet
+        self.ids = dict((name, []) for name in names)
+        # pending entries left by a previous run are read first
+        self.recovering = True
+
+        for name in names:
+            try:
+                redis.execute_command('XGROUP', 'CREATE', name, self.group,
+                                      '0', 'MKSTREAM')
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    def read(self, size):
+        """
+        Read up to size messages from each lane in a single round trip, those
+        of the first lanes first
+
+        If the streams have no new entries, block until one arrives (or a 1
+        second timeout).
+        """
+        if self.recovering:
+            entries = self._read(size, '0')
+            if entries:
+                return self._recover(entries)
+            self.recovering = False
+
+        entries = self._read(size, '>', 'BLOCK', 1000)
+        return [message for _, _, message in entries if message]
+
+    def _read(self, size, start, *block):
+        """
+        Return the entries read as (stream, id, message) tuples
+        """
+        args = ('XREADGROUP', 'GROUP', self.group, self.consumer,
+                'COUNT', size) + block + ('STREAMS',) + tuple(self.names) + \
+            (start,) * len(self.names)
+        entries = dict(self.redis.execute_command(*args) or [])
+
+        read = []
+        for name in self.names:
+            for entry_id, fields in entries.get(name, []):
+                self.ids[name].append(entry_id)
+                # entries trimmed from the stream while pending have no
+                # fields
+                read.append((name, entry_id, fields[1] if fields else None))
+        return read
+
+    def _recover(self, entries):
+        """
+        Return the messages of pending entries, moving the ones delivered
+        too many times to the dead letter streams
+        """
+        deliveries = {}
+        for name in self.names:
+            ids = [entry_id for stream, entry_id, _ in entries
+                   if stream == name]
+            if ids:
+                pending = self.redis.execute_command(
+                    'XPENDING', name, self.group, ids[0], ids[-1], len(ids),
+                    self.consumer)
+                deliveries.update((entry[0], entry[3]) for entry in pending)
+
+        messages = []
+        for name, entry_id, message in entries:
+            if deliveries.get(entry_id, 0) <= self.max_deliveries:
+                if message:
+                    messages.append(message)
+                continue
+
+            logging.error('moving message %s %r to %s:dead after %d '
+                          'deliveries', entry_id, message, name,
+                          deliveries[entry_id])
+            if message:
+                self.redis.execute_command(
+                    'XADD', name + ':dead', 'MAXLEN', '~', self.maxlen, '*',
+                    'm', message)
+            self.redis.execute_command('XACK', name, self.group, entry_id)
+            self.ids[name].remove(entry_id)
+        return messages
+
+    def ack(self):
+        """
+        Acknowledge all the messages read so far
+        """
+        for name, ids in self.ids.iteritems():
+            if ids:
+                self.redis.execute_command('XACK', name, self.group, *ids)
+                self.ids[name] = []
+
+    def push(self, message, name):
+        """
+        Append a message to a stream of the same kind
+        """
+        self.redis.execute_command('XADD', name, 'MAXLEN', '~', self.maxlen,
+                                   '*', 'm', message)
@@ -18,6 +18,7 @@ replies = {
     'ERR_NOSUCHNICK': ('401', '%s :No such nick'),
     'ERR_NOSUCHCHANNEL': ('403', '%s :No such channel'),
     'ERR_CANNOTSENDTOCHAN': ('404', '%s :Cannot send to channel'),
+    'ERR_INPUTTOOLONG': ('417', ':Input line was too long'),
     'ERR_UNKNOWNCOMMAND': ('421', '%s :Unknown command'),
     'ERR_ERRONEOUSNICKNAME': ('432', '%s :Erroneous nickname'),
     'ERR_USERNOTINCHANNEL': ('441', '%s %s :They aren\'t on that channel'),
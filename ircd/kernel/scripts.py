@@ -0,0 +1,116 @@
+import hashlib
+
+
+class Script(object):
+    """
+    A lua script that runs atomically inside redis
+
+    Scripts are loaded with SCRIPT LOAD when the kernel starts and called by
+    their SHA1 digest afterwards.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+
+# deletes an empty channel with its access list, and the timed entries of the
+# access list from access-expiry
+destroy_chan = """
+local function destroy_chan(chan, access, chan_key, expiry)
+    for i, entry in ipairs(redis.call('hkeys', access)) do
+        redis.call('zrem', expiry, chan .. ' ' .. entry)
+    end
+    redis.call('del', access, chan_key)
+end
+"""
+
+# KEYS: chan-nicks:<chan>, chan-users:<chan>, user-chans:<tag>, user:<tag>,
+#       chan-access:<chan>, chan:<chan>, access-expiry
+# ARGV: nick, nick data, tag, chan name
+# a user that disconnected meanwhile is not added, and the channel it may have
+# created is destroyed if empty
+join = Script(destroy_chan + """
+if redis.call('exists', KEYS[4]) == 0 then
+    if redis.call('hlen', KEYS[1]) == 0 then
+        destroy_chan(ARGV[4], KEYS[5], KEYS[6], KEYS[7])
+    end
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('sadd', KEYS[2], ARGV[3])
+redis.call('sadd', KEYS[3], ARGV[4])
+""")
+
+# KEYS: chan-nicks:<chan>, chan-users:<chan>, user-chans:<tag>,
+#       chan-access:<chan>, chan:<chan>, access-expiry
+# ARGV: nick, tag, chan name
+# returns 1 if the channel was destroyed
+part = Script(destroy_chan + """
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('srem', KEYS[2], ARGV[2])
+redis.call('srem', KEYS[3], ARGV[3])
+if redis.call('hlen', KEYS[1]) == 0 then
+    destroy_chan(ARGV[3], KEYS[4], KEYS[5], KEYS[6])
+    return 1
+end
+return 0
+""")
+
+# KEYS: user:<tag>, user-chans:<tag>, server-users:<prefix>, nick-users:<nick>,
+#       access-expiry, then for every channel to part: chan-nicks:<chan>,
+#       chan-users:<chan>, chan-access:<chan>, chan:<chan>
+# ARGV: tag, nick, channels to part...
+# returns the channels that were destroyed
+disconnect = Script(destroy_chan + """
+local destroyed = {}
+for i = 3, #ARGV do
+    local k = 6 + (i - 3) * 4
+    redis.call('hdel', KEYS[k], ARGV[2])
+    redis.call('srem', KEYS[k + 1], ARGV[1])
+    if redis.call('hlen', KEYS[k]) == 0 then
+        destroy_chan(ARGV[i], KEYS[k + 2], KEYS[k + 3], KEYS[5])
+        table.insert(destroyed, ARGV[i])
+    end
+end
+redis.call('del', KEYS[1], KEYS[2])
+redis.call('srem', KEYS[3], ARGV[1])
+redis.call('srem', KEYS[4], ARGV[1])
+return destroyed
+""")
+
+# KEYS: access-expiry
+# ARGV: current time, max number of entries
+# deletes the access list entries whose timeout passed, members of
+# access-expiry are '<chan> <level> <mask>' scored by their timeout
+# returns the deleted members
+# the chan-access:<chan> keys are found in access-expiry, so they can't be
+# passed in KEYS
+access_expire = Script("""
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', '(' .. ARGV[1],
+                       'limit', 0, ARGV[2])
+for i, member in ipairs(due) do
+    local chan, entry = string.match(member, '^(%S+) (.*)$')
+    redis.call('hdel', 'chan-access:' .. chan, entry)
+end
+if #due > 0 then
+    redis.call('zrem', KEYS[1], unpack(due))
+end
+return due
+""")
+
+# KEYS: user-chans:<tag>
+# returns the tags of the members of all the channels of the user
+# the chan-users:<chan> keys are found in user-chans, so they can't be passed
+# in KEYS
+visible = Script("""
+local chans = redis.call('smembers', KEYS[1])
+if #chans == 0 then
+    return {}
+end
+for i, chan in ipairs(chans) do
+    chans[i] = 'chan-users:' .. chan
+end
+return redis.call('sunion', unpack(chans))
+""")
+
+scripts = [join, part, disconnect, access_expire, visible]
@@ -0,0 +1,50 @@
+import logging
+import Queue
+import sys
+import threading
+from ..common.sharding import shard_of
+
+
+class WorkerPool(object):
+    """
+    A pool of threads that process messages concurrently
+
+    Each message is put in the queue of the worker chosen by hashing its key,
+    so messages with the same key are processed in order by the same thread.
+    """
+    def __init__(self, size, process):
+        self.process = process
+        self.queues = [Queue.Queue() for _ in range(size)]
+        self.error = None
+
+        for queue in self.queues:
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+
+    def work(self, queue):
+        while True:
+            message = queue.get()
+            try:
+                self.process(message)
+            except:
+                logging.exception('error processing %r', message)
+                self.error = sys.exc_info()
+            finally:
+                queue.task_done()
+
+    def put(self, key, message):
+        self.queues[shard_of(key, len(self.queues))].put(message)
+
+    def wait(self):
+        """
+        Wait until all queued messages are processed
+
+        An exception raised while processing is raised again here.
+        """
+        for queue in self.queues:
+            queue.join()
+
+        if self.error:
+            (kind, value, traceback), self.error = self.error, None
+            raise kind, value, traceback
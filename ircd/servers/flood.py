@@ -0,0 +1,39 @@
+import time
+
+
+class TokenBucket(object):
+    """
+    Flood control token bucket
+
+    The bucket holds up to burst tokens and refills at rate tokens per second.
+    Every line takes a token; when the bucket is empty it goes into debt, and
+    the line has to wait until the debt is paid back.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self):
+        """
+        Take a token and return how many seconds to wait before using it
+        """
+        self.refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def full(self):
+        """
+        Whether the bucket has refilled to its burst
+        """
+        self.refill()
+        return self.tokens >= self.burst
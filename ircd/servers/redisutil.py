@@ -32,10 +32,14 @@ class RedisMQ(object):
     Warning: Once loop is called, you will not be able to call send anymore.
 
     This class will automatically reconnect if the redis connection goes down.
+
+    If maxlen is given, messages are sent to a redis stream trimmed to about
+    maxlen entries instead of a list.
     """
-    def __init__(self, name, db):
+    def __init__(self, name, db, maxlen=None):
         self.name = name
         self.db = db
+        self.maxlen = maxlen
         self.queue = collections.deque()
 
     @tornado.gen.engine
@@ -52,7 +56,11 @@ class RedisMQ(object):
         Sends a message to the message queue.
         """
         try:
-            self.redis.rpush(self.name, message)
+            if self.maxlen:
+                self.redis.execute_command('XADD', self.name, 'MAXLEN', '~',
+                                           self.maxlen, '*', 'm', message)
+            else:
+                self.redis.rpush(self.name, message)
             print '->', repr(message)
         except:
             self.queue.append(message)
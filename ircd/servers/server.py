@@ -1,59 +1,476 @@
+import collections
+import functools
+import logging
+import time
 import tornado
+import tornado.ioloop
+import flood
 import redisutil
+from ..common import envelope, parser, sharding, timeout
 
 
 class Server(object):
     def __init__(self, name, config):
         self.name = name
+        self.server_name = config.server_name
+        self.max_line_length = config.max_line_length
+        self.max_buffer = config.max_buffer
+        self.max_sendq = config.max_sendq
         self.users = {}
         self.buffers = {}
 
-        self.mq = redisutil.RedisMQ('mq:kernel', config.redis_db)
+        # chan name -> tags of the users of this server in the channel
+        self.chans = {}
+        # tag -> names of the channels of the user
+        self.user_chans = {}
+
+        # tag -> bytes written to the user and not flushed yet
+        self.sendqs = {}
+        # bytes waiting to be flushed to all users, the most ever waiting, and
+        # the number of users disconnected for exceeding max_sendq
+        self.sendq_bytes = 0
+        self.sendq_peak = 0
+        self.sendq_exceeded = 0
+
+        # output is queued and written to each user once per ioloop
+        # iteration, or as soon as flush_size bytes are queued for a user
+        self.flush_size = config.flush_size
+        # tag -> [bytes, lines] queued for the user
+        self.outputs = {}
+        self.flush_scheduled = False
+        # lines queued and writes made, to measure the writes saved
+        self.lines_out = 0
+        self.writes = 0
+
+        # flood control, one bucket per connection and one per address
+        self.flood_rate = config.flood_rate
+        self.flood_burst = config.flood_burst
+        self.flood_ip_rate = config.flood_ip_rate
+        self.flood_ip_burst = config.flood_ip_burst
+        self.flood_max_delay = config.flood_max_delay
+        # tag -> address
+        self.addresses = {}
+        # tag -> bucket
+        self.buckets = {}
+        # address -> [bucket, number of connections]
+        self.ip_buckets = {}
+        # addresses without connections, whose buckets are kept until they
+        # refill so reconnecting doesn't clear the debt
+        self.idle_addresses = set()
+        # tag -> deque of (release time, line) delayed by flood control
+        self.held = {}
+        # lines delayed and users disconnected by flood control
+        self.throttled = 0
+        self.flooded = 0
+
+        # one queue per kernel shard and lane
+        self.shards = config.kernel_shards
+        maxlen = config.stream_maxlen if config.streams else None
+        self.mqs = [
+            dict((lane, redisutil.RedisMQ(
+                sharding.kernel_queue(shard, self.shards, lane),
+                config.redis_db, maxlen)) for lane in sharding.lanes)
+            for shard in range(self.shards)]
         self.mq_in = redisutil.RedisMQ('mq:' + self.name, config.redis_db)
+        self.redis_db = config.redis_db
+
+        # backpressure, users are not read from while the kernel shards lag
+        # behind more than backpressure_high seconds, until they catch up to
+        # backpressure_low seconds
+        self.backpressure_high = config.backpressure_high
+        self.backpressure_low = config.backpressure_low
+        self.paused = False
+        # tag -> callback that reads more data from the user
+        self.stalled = {}
+        # times reading was paused
+        self.pauses = 0
+
+        # with endpoint keepalive, PINGs are answered and idle users
+        # disconnected here
+        self.timeout = None
+        if config.endpoint_keepalive:
+            self.timeout = timeout.Timeout(self, config)
 
     def stop(self):
-        self.mq.send('reset %s server stop' % self.name)
+        self.broadcast('reset', self.name, 'server stop')
+        logging.info('%s: %d bytes in send queues, %d peak, %d users '
+                     'exceeded the send queue', self.name, self.sendq_bytes,
+                     self.sendq_peak, self.sendq_exceeded)
+        logging.info('%s: %d lines written in %d writes', self.name,
+                     self.lines_out, self.writes)
+        logging.info('%s: %d lines throttled, %d users flooded', self.name,
+                     self.throttled, self.flooded)
+        logging.info('%s: reading paused %d times', self.name, self.pauses)
 
     @tornado.gen.engine
     def connect(self, callback=None):
-        yield tornado.gen.Task(self.mq.connect)
+        for mqs in self.mqs:
+            for mq in mqs.itervalues():
+                yield tornado.gen.Task(mq.connect)
         yield tornado.gen.Task(self.mq_in.connect)
         self.mq_in.loop(self.server_message)
-        self.mq.send('reset %s server restart' % self.name)
+        self.broadcast('reset', self.name, 'server restart')
+
+        if self.timeout:
+            tornado.ioloop.PeriodicCallback(self.timeout.check, 1000).start()
+
+        self.redis = yield tornado.gen.Task(redisutil.new_redis, self.redis_db)
+        tornado.ioloop.PeriodicCallback(self.check_lag, 1000).start()
+        tornado.ioloop.PeriodicCallback(self.sweep_buckets, 1000).start()
+
         callback()
 
+    def sweep_buckets(self):
+        """
+        Forget the buckets of the addresses without connections once they
+        have refilled
+        """
+        for address in list(self.idle_addresses):
+            if self.ip_buckets[address][0].full():
+                del self.ip_buckets[address]
+                self.idle_addresses.remove(address)
+
+    def check_lag(self):
+        """
+        Read how far behind the kernel shards are
+        """
+        keys = [sharding.lag_key(shard) for shard in range(self.shards)]
+        self.redis.mget(keys, callback=self.set_lags)
+
+    def set_lags(self, lags):
+        """
+        Pause or resume reading from the users according to the lag of the
+        slowest kernel shard
+        """
+        if isinstance(lags, Exception):
+            return
+
+        lag = max(float(lag or 0) for lag in lags)
+        if not self.paused and lag >= self.backpressure_high:
+            logging.warning('%s: kernel %.3fs behind, pausing', self.name, lag)
+            self.paused = True
+            self.pauses += 1
+        elif self.paused and lag <= self.backpressure_low:
+            logging.info('%s: kernel %.3fs behind, resuming', self.name, lag)
+            self.paused = False
+            stalled, self.stalled = self.stalled, {}
+            for read in stalled.itervalues():
+                read()
+
+    def read_more(self, tag, read):
+        """
+        Called by the endpoints before reading more data from a user, read
+        is called right away or once the kernel catches up
+        """
+        if tag not in self.users:
+            return
+        if self.paused:
+            self.stalled[tag] = read
+        else:
+            read()
+
+    def send_kernel(self, shard, kind, origin, data):
+        """
+        Send a message to a kernel shard, in the lane of its kind
+        """
+        message = envelope.message(kind, origin, data)
+        self.mqs[shard][sharding.lane_of(kind)].send(message)
+
+    def broadcast(self, kind, origin, data):
+        """
+        Send a message to all kernel shards
+        """
+        for shard in range(self.shards):
+            self.send_kernel(shard, kind, origin, data)
+
+    def send_home(self, kind, tag, data):
+        """
+        Send a message to the home shard of a user
+        """
+        shard = sharding.shard_of(tag, self.shards)
+        self.send_kernel(shard, kind, tag, data)
+
     def make_tag(self, address, port):
         address = address.replace(':', '_')
         return '%s:%s-%s' % (self.name, address, port)
 
     def server_message(self, message):
-        targets, message = message.split(' ', 1)
+        """
+        Handle a message from the kernel
+
+        Lines are sent to a list of tags or to the channel members among the
+        users of this server, except one. join and part messages keep track
+        of the channel members. A batch holds several messages, in order.
+        """
+        try:
+            fields = envelope.loads(message)
+        except ValueError as e:
+            # don't let a message that can't be read end the queue loop
+            logging.error('%s: dropping message %r: %s', self.name, message, e)
+            return
+
+        self.handle(fields)
+
+    def handle(self, fields):
+        if isinstance(fields[0], list):
+            targets, line = fields
+            for target in targets:
+                self.write(target, line)
+
+        elif fields[0] == 'chan':
+            _, chan, skip, line = fields
+            # writing may disconnect users
+            for target in list(self.chans.get(chan, ())):
+                if target != skip:
+                    self.write(target, line)
+
+        elif fields[0] == 'join':
+            _, chan, tag = fields
+            if tag in self.users:
+                self.chans.setdefault(chan, set()).add(tag)
+                self.user_chans[tag].add(chan)
 
-        for target in targets.split(','):
-            if target in self.users:
-                self.users[target](message)
+        elif fields[0] == 'part':
+            _, chan, tag = fields
+            if tag in self.users:
+                self.part(tag, chan)
+
+        elif fields[0] == 'batch':
+            for message in fields[1]:
+                self.handle(message)
+
+    def part(self, tag, chan):
+        """
+        Remove a user from the members of a channel
+        """
+        self.user_chans[tag].discard(chan)
+        members = self.chans.get(chan)
+        if members is not None:
+            members.discard(tag)
+            if not members:
+                del self.chans[chan]
 
     def user_connect(self, tag, address, handler):
         self.users[tag] = handler
-        self.buffers[tag] = []
-        self.mq.send('connect %s %s' % (tag, address))
+        self.buffers[tag] = bytearray()
+        self.user_chans[tag] = set()
+        self.sendqs[tag] = 0
+        self.send_home('connect', tag, address)
+
+        self.addresses[tag] = address
+        self.buckets[tag] = flood.TokenBucket(self.flood_rate,
+                                              self.flood_burst)
+        ip_bucket = self.ip_buckets.get(address)
+        if ip_bucket is None:
+            ip_bucket = self.ip_buckets[address] = [flood.TokenBucket(
+                self.flood_ip_rate, self.flood_ip_burst), 0]
+        self.idle_addresses.discard(address)
+        ip_bucket[1] += 1
+
+        if self.timeout:
+            self.timeout.update(tag)
 
     def user_message(self, tag, data):
+        if tag not in self.users:
+            return
+
+        if self.timeout:
+            self.timeout.update(tag)
+
+        # split the complete lines, the buffered bytes have no newline so
+        # every byte is scanned once
         buf = self.buffers[tag]
-        while True:
-            index = data.find('\n')
+        scan = len(buf)
+        buf.extend(data)
+
+        start = 0
+        while tag in self.users:
+            index = buf.find('\n', scan)
             if index == -1:
-                buf.append(data)
                 break
-            buf.append(data[:index])
-            data = data[index + 1:]
-            message, buf[:] = ''.join(buf).strip(), []
-            message = message.replace("\r", "")
+            message = str(buf[start:index]).strip().replace('\r', '')
+            start = scan = index + 1
             if message:
-                self.mq.send('message %s %s' % (tag, message))
+                self.throttle(tag, message)
+
+        if tag not in self.users:
+            return
+
+        del buf[:start]
+        if len(buf) > self.max_buffer:
+            self.close(tag, 'Input buffer exceeded')
+
+    def throttle(self, tag, line):
+        """
+        Pass a line from a user through flood control
+
+        Lines over the limits wait in the held queue of the user, which is
+        released in order. A user that would have to wait more than
+        flood_max_delay seconds is disconnected.
+        """
+        delay = max(self.buckets[tag].take(),
+                    self.ip_buckets[self.addresses[tag]][0].take())
+        held = self.held.get(tag)
+
+        if not delay and not held:
+            self.parse_message(tag, line)
+            return
+
+        if delay > self.flood_max_delay:
+            self.flooded += 1
+            self.close(tag, 'Excess Flood')
+            return
+
+        self.throttled += 1
+        release = time.time() + delay
+        if held:
+            held.append((release, line))
+            return
+
+        self.held[tag] = collections.deque([(release, line)])
+        tornado.ioloop.IOLoop.instance().add_timeout(
+            release, functools.partial(self.release, tag))
+
+    def release(self, tag):
+        """
+        Process the held lines of a user whose time has come
+        """
+        held = self.held.get(tag)
+        now = time.time()
+        while held and held[0][0] <= now:
+            release, line = held.popleft()
+            self.parse_message(tag, line)
+            if tag not in self.users:
+                return
+
+        if held:
+            tornado.ioloop.IOLoop.instance().add_timeout(
+                held[0][0], functools.partial(self.release, tag))
+        else:
+            self.held.pop(tag, None)
+
+    def parse_message(self, tag, line):
+        """
+        Validate and tokenize a line from a user and send it to the kernel
+
+        Invalid lines are answered here and never reach the kernel.
+        """
+        try:
+            cmd, params = parser.parse(line, self.max_line_length)
+        except parser.ParseError as e:
+            self.write(tag, ':%s %s * %s\r\n' % (
+                self.server_name, e.numeric, e.text))
+            return
+
+        if self.timeout and cmd in ('PING', 'PONG'):
+            if cmd == 'PING':
+                self.send(tag, ':%s PONG %s %s' % (
+                    self.server_name, self.server_name, params[0]))
+            return
+
+        # route the message to the shards that own its targets
+        for shard, part in sharding.route(tag, cmd, params, self.shards):
+            self.send_kernel(shard, 'message', tag, [cmd, part])
 
     def user_disconnect(self, tag, reason=''):
         if tag in self.users:
             del self.users[tag]
             del self.buffers[tag]
-            self.mq.send('disconnect %s %s' % (tag, reason))
+            for chan in list(self.user_chans[tag]):
+                self.part(tag, chan)
+            del self.user_chans[tag]
+            self.sendq_bytes -= self.sendqs.pop(tag)
+            self.outputs.pop(tag, None)
+            self.held.pop(tag, None)
+            self.stalled.pop(tag, None)
+            del self.buckets[tag]
+            address = self.addresses.pop(tag)
+            ip_bucket = self.ip_buckets[address]
+            ip_bucket[1] -= 1
+            if not ip_bucket[1]:
+                self.idle_addresses.add(address)
+            self.send_home('disconnect', tag, reason)
+
+            if self.timeout:
+                self.timeout.remove(tag)
+
+    def send(self, tag, line):
+        """
+        Send a line to a user, used for keepalive PINGs
+        """
+        self.write(tag, line + '\r\n')
+
+    def write(self, tag, data):
+        """
+        Queue data to be written to a user, disconnecting it if its send queue
+        would grow past max_sendq
+
+        Empty data closes the connection once the queued data is written.
+        """
+        if tag not in self.users:
+            return
+
+        if not data:
+            self.flush_user(tag)
+            self.users[tag]('')
+            return
+
+        sendq = self.sendqs[tag] + len(data)
+        if sendq > self.max_sendq:
+            self.sendq_exceeded += 1
+            self.close(tag, 'SendQ exceeded')
+            return
+
+        self.sendqs[tag] = sendq
+        self.sendq_bytes += len(data)
+        self.sendq_peak = max(self.sendq_peak, self.sendq_bytes)
+        self.lines_out += 1
+
+        output = self.outputs.get(tag)
+        if output is None:
+            output = self.outputs[tag] = [0, []]
+        output[0] += len(data)
+        output[1].append(data)
+
+        if output[0] >= self.flush_size:
+            self.flush_user(tag)
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.flush)
+
+    def flush(self):
+        """
+        Write the queued output of all users
+        """
+        self.flush_scheduled = False
+        for tag in self.outputs.keys():
+            self.flush_user(tag)
+
+    def flush_user(self, tag):
+        output = self.outputs.pop(tag, None)
+        if output is not None:
+            self.writes += 1
+            self.users[tag](''.join(output[1]))
+
+    def user_drained(self, tag):
+        """
+        Called by the endpoints when all the data written to a user was
+        flushed
+        """
+        if tag in self.sendqs:
+            self.sendq_bytes -= self.sendqs[tag]
+            self.sendqs[tag] = 0
+
+    def disconnect(self, user):
+        """
+        Close the connection of a user that timed out
+        """
+        self.close(user['tag'], 'Ping timeout')
+
+    def close(self, tag, reason):
+        """
+        Close the connection of a user and tell the kernel
+        """
+        if tag in self.users:
+            self.users[tag]('')
+            self.user_disconnect(tag, reason)
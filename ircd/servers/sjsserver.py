@@ -1,5 +1,6 @@
 import functools
 import tornado
+import tornado.websocket
 import sockjs.tornado
 from server import Server
 
@@ -15,11 +16,26 @@ class Connection(sockjs.tornado.SockJSConnection):
         def handler(data):
             if data:
                 self.send(data.decode('utf-8'))
+                self.drain()
             else:
                 self.close()
 
         self.server.user_connect(self.tag, info.ip, handler)
 
+    def drain(self):
+        # polling transports queue messages until the client polls
+        if getattr(self.session, 'send_queue', None):
+            return
+        drained = functools.partial(self.server.user_drained, self.tag)
+        handler = getattr(self.session, 'handler', None)
+        if (isinstance(handler, tornado.websocket.WebSocketHandler) and
+                not handler.stream.closed()):
+            # websockets buffer in the stream, which runs the write
+            # callback once its buffer is empty
+            handler.stream.write(b'', drained)
+        else:
+            drained()
+
     def on_message(self, message):
         self.server.user_message(self.tag, message.encode('utf-8'))
 
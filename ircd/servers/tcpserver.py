@@ -1,9 +1,13 @@
 import logging
 import functools
 import tornado.gen
+import tornado.ioloop
 import tornado.tcpserver
 from server import Server
 
+# bytes read from a user before checking if the kernel is keeping up
+chunk_size = 4096
+
 
 class TCPServer(tornado.tcpserver.TCPServer):
     @tornado.gen.engine
@@ -11,6 +15,8 @@ class TCPServer(tornado.tcpserver.TCPServer):
         super(TCPServer, self).__init__()
 
         self.server = Server('tcp', config)
+        # tags of the stalled users whose streams don't listen for reads
+        self.muted = set()
         yield tornado.gen.Task(self.server.connect)
 
         logging.info('Starting IRCd server on port \'%d\'', config.tcp_port)
@@ -22,12 +28,60 @@ class TCPServer(tornado.tcpserver.TCPServer):
     def handle_stream(self, stream, address):
         tag = self.server.make_tag(address[0], address[1])
 
-        u_handler = functools.partial(self.handle_user_data, tag)
-        stream.read_until_close(u_handler, u_handler)
+        stream.set_close_callback(
+            functools.partial(self.stream_closed, tag))
 
         s_handler = functools.partial(self.handle_server_data, tag, stream)
         self.server.user_connect(tag, address[0], s_handler)
 
+        self.read_chunk(tag, stream)
+
+    def read_chunk(self, tag, stream):
+        # the data is handed over as it arrives, the next chunk is only read
+        # if the kernel is keeping up
+        if not stream.closed():
+            stream.read_bytes(
+                chunk_size, functools.partial(self.chunk_read, tag, stream),
+                functools.partial(self.handle_user_data, tag))
+            if tag in self.muted:
+                self.muted.discard(tag)
+                self.listen_reads(stream, True)
+
+    def chunk_read(self, tag, stream, data):
+        self.server.read_more(
+            tag, functools.partial(self.read_chunk, tag, stream))
+        self.check_stalled(tag, stream)
+
+    def check_stalled(self, tag, stream):
+        # an idle stream keeps listening for reads to notice closes, and
+        # buffers whatever arrives, so the reads of a stalled user are
+        # turned off until the kernel catches up and the tcp window fills.
+        # the callback runs after the stream registered its own events
+        if tag in self.server.stalled:
+            stream.io_loop.add_callback(
+                functools.partial(self.mute, tag, stream))
+
+    def mute(self, tag, stream):
+        if tag in self.server.stalled and not stream.closed():
+            self.muted.add(tag)
+            self.listen_reads(stream, False)
+
+    def listen_reads(self, stream, reading):
+        # tornado 3.0 keeps READ registered while a stream is idle, and
+        # registers it again when a write completes, so it is overridden
+        # through the ioloop: the stream keeps its own record of the events
+        # and registers them again on its next read or write
+        events = tornado.ioloop.IOLoop.ERROR
+        if reading:
+            events |= tornado.ioloop.IOLoop.READ
+        if stream.writing():
+            events |= tornado.ioloop.IOLoop.WRITE
+        stream.io_loop.update_handler(stream.fileno(), events)
+
+    def stream_closed(self, tag):
+        self.muted.discard(tag)
+        self.server.user_disconnect(tag)
+
     def handle_user_data(self, tag, data):
         if data:
             self.server.user_message(tag, data)
@@ -37,8 +91,10 @@ class TCPServer(tornado.tcpserver.TCPServer):
     def handle_server_data(self, tag, stream, data):
         try:
             if data:
-                # this might fail if the connection is closed
-                stream.write(data)
+                # this might fail if the connection is closed, the callback
+                # runs once the write buffer is empty
+                stream.write(data, functools.partial(
+                    self.data_written, tag, stream))
             else:
                 stream.close()
         except:
@@ -47,3 +103,8 @@ class TCPServer(tornado.tcpserver.TCPServer):
                 stream.close()
             finally:
                 self.server.user_disconnect(tag)
+
+    def data_written(self, tag, stream):
+        self.server.user_drained(tag)
+        # the stream listens for reads again once its writes are done
+        self.check_stalled(tag, stream)
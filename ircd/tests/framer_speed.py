@@ -0,0 +1,64 @@
+"""
+Line framing of pasted bursts
+
+A client pastes a few KB of text, delivered in small chunks. The old framer
+sliced the remaining data after every line and joined the buffered pieces
+again for every chunk, the new one scans each byte once.
+
+Run from the top directory with: python -m ircd.tests.framer_speed [kbytes]
+"""
+import sys
+import time
+
+kbytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+chunk = 1400
+line = 'PRIVMSG #test :' + 'x' * 80 + '\r\n'
+data = line * (kbytes * 1024 / len(line))
+chunks = [data[i:i + chunk] for i in xrange(0, len(data), chunk)]
+rounds = 20
+
+
+def old(chunks, handle):
+    buf = []
+    for data in chunks:
+        while True:
+            index = data.find('\n')
+            if index == -1:
+                buf.append(data)
+                break
+            buf.append(data[:index])
+            data = data[index + 1:]
+            message, buf[:] = ''.join(buf).strip(), []
+            message = message.replace('\r', '')
+            if message:
+                handle(message)
+
+
+def new(chunks, handle):
+    buf = bytearray()
+    for data in chunks:
+        scan = len(buf)
+        buf.extend(data)
+        start = 0
+        while True:
+            index = buf.find('\n', scan)
+            if index == -1:
+                break
+            message = str(buf[start:index]).strip().replace('\r', '')
+            start = scan = index + 1
+            if message:
+                handle(message)
+        del buf[:start]
+
+
+for name, framer in [('old', old), ('new', new)]:
+    lines = []
+    start = time.time()
+    for _ in xrange(rounds):
+        del lines[:]
+        framer(chunks, lines.append)
+    duration = time.time() - start
+
+    print '%s %8.0f lines/s %6.1f MB/s' % (
+        name, len(lines) * rounds / duration,
+        len(data) * rounds / duration / 1024 / 1024)
@@ -147,3 +147,165 @@ def test_access_clear(k1):
 
     msg('ACCESS #a LIST GRANT')
     assert (code(), code()) == ('803', '805')
+
+
+def test_matcher():
+    from ircd.kernel.acl import Matcher
+
+    entries = [('DENY', 'bad%d!*@*' % i, 0, '', '') for i in range(1000)]
+    entries.append(('DENY', 'nick!user@host', 0, '', ''))
+    entries.append(('VOICE', '*!*@host', 0, '', ''))
+    matcher = Matcher(entries)
+
+    assert matcher.match('nick!user@host') == set(['DENY', 'VOICE'])
+    assert matcher.match('bad12!x@y') == set(['DENY'])
+    assert matcher.match('bad12x!x@y') == set()
+    assert matcher.match('a!b@host') == set(['VOICE'])
+
+
+def test_matcher_cache(k1):
+    msg('JOIN #a')
+    popall()
+
+    chan = k1.find_chan('#a')
+    matcher = k1.access_matcher(chan)
+    assert k1.access_matcher(chan) is matcher
+
+    msg('ACCESS #a ADD DENY test2')
+    popall()
+    assert k1.access_matcher(chan) is not matcher
+
+    user(2)
+    msg('JOIN #a', 2)
+    assert code() == '474'  # banned
+
+    msg('ACCESS #a DELETE DENY test2')
+    popall()
+
+    msg('JOIN #a', 2)
+    assert code() == 'JOIN'
+
+
+def test_matcher_forget(k1):
+    user(2)
+    msg('JOIN #a')
+    msg('JOIN #b')
+    msg('JOIN #b', 2)
+    popall()
+    for name in ['#a', '#b']:
+        k1.access_matcher(k1.find_chan(name))
+
+    # destroyed channels are forgotten, when they are parted or left by a
+    # disconnect
+    msg('PART #a')
+    raw('disconnect test:__2 bye')
+    msg('PART #b')
+    assert not k1.access_versions
+    assert not k1.access_matchers
+
+
+def test_matcher_sweep(kp):
+    user(1)
+    msg('JOIN #a')
+    kp.access_matcher(kp.find_chan('#a'))
+
+    # pipelined scripts don't say what they destroyed
+    msg('PART #a')
+    assert '#a' in kp.access_matchers
+    kp.sweep_chans()
+    assert not kp.access_versions
+    assert not kp.access_matchers
+
+
+def test_matcher_timeout(k1):
+    msg('JOIN #a')
+    popall()
+
+    old_time = time.time
+    set_time(1)
+
+    msg('ACCESS #a ADD DENY test2 15')
+    popall()
+
+    user(2)
+    msg('JOIN #a', 2)
+    assert code() == '474'  # banned
+
+    # the cached matcher is dropped when the ban expires
+    set_time(20 * 60)
+    msg('JOIN #a', 2)
+    assert code() == 'JOIN'
+
+    time.time = old_time
+
+
+def test_access_reap(k1):
+    msg('JOIN #a')
+    popall()
+
+    old_time = time.time
+    set_time(1)
+
+    msg('ACCESS #a ADD DENY test2 15')
+    msg('ACCESS #a ADD DENY test3 16')
+    msg('ACCESS #a ADD DENY test4 15')
+    msg('ACCESS #a ADD DENY test4')  # no longer timed
+    msg('ACCESS #a ADD DENY test5 60')
+    popall()
+    assert r.zcard('access-expiry') == 3
+
+    k1.reap_access()
+    assert r.hlen('chan-access:#a') == 5
+
+    set_time(950)
+    k1.reap_access()
+    assert r.hlen('chan-access:#a') == 4
+
+    set_time(1000)
+    k1.reap_access()
+    assert r.hlen('chan-access:#a') == 4  # runs once a minute
+
+    set_time(1010)
+    k1.reap_access()
+    assert r.hlen('chan-access:#a') == 3
+    assert r.zrange('access-expiry', 0, -1) == ['#a DENY test5!*@*']
+
+    msg('ACCESS #a DELETE DENY test5')
+    popall()
+    assert r.zcard('access-expiry') == 0
+
+    time.time = old_time
+
+
+def test_access_destroy(k1):
+    for leave in ['PART #a', None]:
+        msg('JOIN #a')
+        msg('ACCESS #a ADD DENY test5 60')
+        popall()
+        assert r.zcard('access-expiry') == 1
+
+        # the timed entries go away with the channel
+        if leave:
+            msg(leave)
+        else:
+            raw('disconnect test:__1 bye')
+        popall()
+        assert not r.exists('chan-access:#a')
+        assert r.zcard('access-expiry') == 0
+
+
+def test_access_index(k1):
+    r.hset('chan-access:#a', 'DENY test2!*@*', '100 test1!test1@::1 ')
+    r.hset('chan-access:#a', 'OWNER test1!*@*', '0 test1!test1@::1 ')
+    r.zadd('access-expiry', 50, '#b DENY test3!*@*')
+    r.delete('access-expiry-indexed')
+
+    # entries from before the index are indexed, destroyed channels dropped
+    Kernel(Config())
+    assert r.zrange('access-expiry', 0, -1, withscores=True) == [
+        ('#a DENY test2!*@*', 100)]
+
+    # only once
+    r.zadd('access-expiry', 50, '#b DENY test3!*@*')
+    Kernel(Config())
+    assert r.zcard('access-expiry') == 2
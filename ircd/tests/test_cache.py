@@ -0,0 +1,84 @@
+import pytest
+from testutil import *
+from ircd.kernel import redisutil
+
+
+def test_chan(kc):
+    user(1)
+    user(2)
+    msg('JOIN #a,#b', 1)
+    msg('JOIN #a', 2)
+    msg('MODE #a +o test2', 1)
+    msg('TOPIC #a :hello', 2)
+    assert kc.cache.chan_nicks['#a']['test2']['modes'] == 'o'
+    assert kc.cache.chans['#a']['topic'] == 'hello'
+
+    msg('KICK #a test2', 1)
+    msg('PART #b', 1)
+    popall()
+
+    assert kc.cache.chans.keys() == ['#a']
+    assert kc.cache.chan_users == {'#a': set(['test:__1'])}
+    assert kc.cache.user_chans == {'test:__1': set(['#a'])}
+
+
+def test_disconnect(kc):
+    user(1)
+    user(2)
+    msg('JOIN #a', 1)
+    msg('JOIN #a', 2)
+    popall()
+
+    raw('disconnect test:__1 bye')
+    assert pop() == 'test:__2 :test1!test1@::1 QUIT :bye\r\n'
+    assert 'test:__1' not in kc.cache.users
+
+    raw('reset test bye')
+    assert kc.cache.users == {}
+    assert kc.cache.chans == {}
+
+
+def test_privmsg(kc):
+    user(1)
+    user(2)
+    msg('JOIN #a', 1)
+    msg('JOIN #a', 2)
+    popall()
+
+    msg('PRIVMSG #a :hi', 1)
+    assert pop() == 'test:__2 :test1!test1@::1 PRIVMSG #a :hi\r\n'
+
+    # only the queue push
+    count, round_trips = kc.round_trips['PRIVMSG']
+    assert round_trips == count == 1
+
+
+def test_reload(kc, monkeypatch):
+    user(1)
+    msg('JOIN #a', 1)
+    msg('AWAY :afk', 1)
+    popall()
+
+    user(2)
+    msg('JOIN #a,#b', 2)
+    popall()
+
+    # the keyspace is never walked with KEYS
+    def keys(self, pattern):
+        raise AssertionError('KEYS %s' % pattern)
+    monkeypatch.setattr(redisutil.Redis, 'keys', keys)
+
+    cache = kc.cache
+    k = Kernel(kc.config)
+    assert k.cache.__dict__ == cache.__dict__
+    assert sorted(k.timeout.last_seen.keys()) == ['test:__1', 'test:__2']
+
+
+def test_check(kc):
+    user(1)
+    msg('JOIN #a', 1)
+    popall()
+
+    r.srem('chan-users:#a', 'test:__1')
+    with pytest.raises(RuntimeError):
+        kc.check_cache()
@@ -68,7 +68,8 @@ def test_part2(k1):
     popall()
 
     raw('disconnect test:__1 reason')
-    assert pop() == 'test:__1 :test1!test1@::1 PART #b\r\n'
+    assert pop() == 'test:__2 :test1!test1@::1 QUIT :reason\r\n'
+    assert pop() is None
 
 
 def test_names(k1):
@@ -89,6 +90,102 @@ def test_names(k1):
     assert code() == '366'
 
 
+def test_names_cache(k1):
+    msg('JOIN #a')
+    user(2)
+    msg('JOIN #a', 2)
+    popall()
+
+    msg('NAMES #a')
+    names, lines = k1.names_cache['#a'][1:]
+    assert sorted(names) == ['.test1', 'test2']
+    assert lines.values() == [[' '.join(names)]]
+    popall()
+
+    # served from the cache
+    k1.chan_nicks = None
+    msg('NAMES #a', 2)
+    assert code() == '353'
+    assert code() == '366'
+    del k1.chan_nicks
+
+    msg('MODE #a +v test2')
+    msg('NAMES #a')
+    popall()
+    assert sorted(k1.names_cache['#a'][1]) == ['+test2', '.test1']
+
+    msg('PART #a', 2)
+    assert '#a' not in k1.names_cache
+
+
+def test_names_forget(k1):
+    user(2)
+    msg('JOIN #a')
+    msg('JOIN #b')
+    msg('JOIN #b', 2)
+    msg('NAMES #a')
+    msg('NAMES #b')
+    popall()
+
+    # destroyed channels are forgotten, when they are parted or left by a
+    # disconnect
+    msg('PART #a')
+    raw('disconnect test:__2 bye')
+    msg('PART #b')
+    assert not k1.names_versions
+    assert not k1.names_cache
+
+
+def test_names_sweep(kp):
+    user(1)
+    msg('JOIN #a')
+    msg('NAMES #a')
+    popall()
+
+    # pipelined scripts don't say what they destroyed
+    msg('PART #a')
+    assert '#a' in kp.names_versions
+    kp.sweep_chans()
+    assert not kp.names_versions
+
+
+def test_names_split(k1):
+    msg('JOIN #a')
+    for n in range(2, 100):
+        user(n)
+        msg('JOIN #a', n)
+    popall()
+
+    msg('NAMES #a')
+    lines = []
+    while True:
+        line = pop()
+        if code(line) == '366':
+            break
+        assert code(line) == '353'
+        assert len(line.split(' ', 1)[1]) <= 512
+        lines.append(line)
+
+    assert len(lines) == 2
+    nicks = ' '.join(line.rstrip().split(' :')[-1] for line in lines)
+    assert len(nicks.split()) == 99
+
+
+def test_join_names_limit(k1):
+    k1.config.join_names_limit = 1
+    user(2)
+    msg('JOIN #a', 2)
+    popall()
+
+    msg('JOIN #a')
+    assert code() == 'JOIN'
+    assert code() == '331'
+    assert code() == '366'
+
+    msg('NAMES #a')
+    assert code() == '353'
+
+
 def test_multiple(k1):
     msg('JOIN #a,#b')
     popall()
@@ -1,17 +1,70 @@
 from testutil import *
+from ircd.common import sharding
 
 
 def test_reset(k1):
-    msg('JOIN #a')
+    user(2)
+    raw('connect other:__3 ::3')
+    raw('message other:__3 USER test3 hn sn :real name')
+    raw('message other:__3 NICK test3')
+    msg('JOIN #a,#b')
+    msg('JOIN #b', 2)
+    msg('JOIN #c', 2)
+    raw('message other:__3 JOIN #a,#b')
     popall()
+    r.delete('mq:other')
 
-    raw('reset test ')
-    assert pop() == 'test:__1 :test1!test1@::1 PART #a\r\n'
+    # test3 hears about both users at once, nobody else is left
+    raw('reset test bye')
+    tags, line = envelope.loads(r.lpop('mq:other'))
+    assert tags == ['other:__3']
+    assert sorted(line.split('\r\n')) == [
+        '', ':test1!test1@::1 QUIT :bye', ':test2!test2@::2 QUIT :bye']
+    assert r.lpop('mq:other') is None
+    assert pop() is None
 
+    assert r.smembers('chan-users:#a') == set(['other:__3'])
+    assert r.smembers('chan-users:#b') == set(['other:__3'])
+    assert not r.exists('server-users:test')
+    assert not r.exists('user:test:__1')
+    # the channel that was destroyed is forgotten
+    assert sorted(k1.access_versions) == ['#a', '#b']
+    assert sorted(k1.names_versions) == ['#a', '#b']
 
-def test_utf8(k1):
-    msg('PING \xAA\xAA\xAA\xAA\xAA\xAA\xAA\xAA')
-    assert code() == '998'  # invalid utf8
+
+def test_envelope(k1):
+    # commas and spaces in tags can't get mixed up with the tag list
+    k1.send(['test:a,b', 'test:c d'], 'PING x')
+    assert r.lpop('mq:test') == envelope.dumps(
+        ['test:a,b', 'test:c d'], 'PING x\r\n')
+
+    with pytest.raises(ValueError):
+        envelope.loads('\x00' + frame('connect test:__2 ::2')[1:])
+
+
+def test_bad_envelope():
+    k = kernel()
+
+    # a message of an older server doesn't stop the rest of the batch
+    r.rpush('mq:kernel', '\x01' + frame('connect test:__1 ::1')[1:])
+    r.rpush('mq:kernel', frame('connect test:__2 ::2'))
+    r.rpush('mq:kernel', frame('shutdown test test'))
+    k.loop()
+
+    assert not r.exists('user:test:__1')
+    assert r.exists('user:test:__2')
+
+
+def test_arity(k1):
+    # tokenized by a server that doesn't agree on the number of parameters
+    k1.process_message(envelope.message(
+        'message', 'test:__1', ['TOPIC', ['#a']]))
+    assert pop() == 'test:__1 :testserver 461 test1 TOPIC :Not enough ' \
+        'parameters\r\n'
+
+    k1.process_message(envelope.message(
+        'message', 'test:__1', ['AWAY', ['a', 'b']]))
+    assert code() == '461'
 
 
 def test_nouser(k0):
@@ -26,9 +79,133 @@ def test_main():
     from ircd.kernel.main import main
 
     r = redis.StrictRedis(db=1)
-    r.rpush('mq:kernel', 'shutdown test test')
+    r.rpush('mq:kernel', frame('shutdown test test'))
 
     main(Config())
 
     # control should reach here
     assert True
+
+
+def test_batch():
+    k = kernel(batch_size=2)
+
+    r.rpush('mq:kernel', frame('connect test:__1 ::1'))
+    r.rpush('mq:kernel', frame('message test:__1 NICK test1'))
+    r.rpush('mq:kernel', frame('shutdown test test'))
+    r.rpush('mq:kernel', frame('message test:__1 USER test1'))
+    join = frame('message test:__1 JOIN #a')
+    r.rpush('mq:kernel', join)
+
+    k.loop()
+
+    # the batch with the shutdown message is processed to the end
+    assert code() == '001'
+    assert r.lrange('mq:kernel', 0, -1) == [join]
+
+
+def test_stop_reading():
+    k = kernel()
+
+    r.rpush('mq:kernel', frame('connect test:__1 ::1'))
+    r.rpush('mq:kernel', frame('message test:__1 NICK test1'))
+    r.rpush('mq:kernel', frame('message test:__1 USER test1'))
+
+    # a signal arrives while the batch is being read
+    read_messages = k.read_messages
+
+    def interrupted():
+        messages = read_messages()
+        k.stop()
+        return messages
+    k.read_messages = interrupted
+    k.loop()
+
+    # the messages already taken from the queue are processed
+    assert code() == '001'
+    assert r.llen('mq:kernel') == 0
+
+
+def test_lanes():
+    k = kernel(batch_size=2)
+
+    user(1)
+    for i in range(5):
+        r.rpush('mq:kernel', frame('message test:__1 PRIVMSG test1 :%d' % i))
+    r.rpush('mq:kernel:high', frame('shutdown test test'))
+    high = k.lane_stats['high'][0]
+
+    k.loop()
+
+    # the shutdown skipped ahead, only the first batch of the normal lane
+    # was processed
+    assert r.llen('mq:kernel') == 3
+    assert k.lane_stats['high'][0] == high + 1
+    assert k.lane_stats['normal'][3] == 3  # depth
+
+
+def test_disconnect_order():
+    k = kernel()
+
+    user(1)
+    user(2)
+    msg('JOIN #a', 1)
+    msg('JOIN #a', 2)
+    popall()
+
+    # queued like the servers do
+    for message in ['message test:__1 PRIVMSG #a :last words',
+                    'disconnect test:__1 bye all',
+                    'shutdown test test']:
+        kind = message.split(' ', 1)[0]
+        queue = sharding.kernel_queue(0, 1, sharding.lane_of(kind))
+        r.rpush(queue, frame(message))
+    k.loop()
+
+    assert pop() == 'test:__2 :test1!test1@::1 PRIVMSG #a :last words\r\n'
+    assert pop() == 'test:__2 :test1!test1@::1 QUIT :bye all\r\n'
+
+
+def test_lag():
+    k = kernel()
+
+    user(1)
+    r.rpush('mq:kernel', envelope.dumps(
+        'message', 'test:__1', ['AWAY', ['x']], time.time() - 3))
+    r.rpush('mq:kernel:high', frame('shutdown test test'))
+    k.loop()
+
+    assert 3 <= float(r.get('kernel-lag:0')) < 4
+    assert 0 < r.ttl('kernel-lag:0') <= 10
+    assert k.lag == 0
+
+
+def script_flush():
+    user(1)
+    user(2)
+
+    # redis lost the scripts loaded on startup
+    r.script_flush()
+
+    msg('JOIN #a', 1)
+    assert code() == 'JOIN'
+
+    r.script_flush()
+    popall()
+
+    msg('JOIN #a', 2)
+    popall()
+    assert r.smembers('chan-users:#a') == set(['test:__1', 'test:__2'])
+
+    r.script_flush()
+    raw('disconnect test:__1 bye')
+    assert not r.exists('user:test:__1')
+    assert r.smembers('chan-users:#a') == set(['test:__2'])
+
+
+def test_script_flush(k0):
+    script_flush()
+
+
+def test_script_flush_pipeline(kp):
+    script_flush()
@@ -0,0 +1,32 @@
+import pytest
+from ircd.common import parser
+from ircd.kernel import command
+
+
+def error(line, max_length=512):
+    with pytest.raises(parser.ParseError) as e:
+        parser.parse(line, max_length)
+    return e.value.numeric
+
+
+def test_parse():
+    assert parser.parse('user a b c :real name', 512) == (
+        'USER', ['a', 'b', 'c', ':real name'])
+    assert parser.parse('PRIVMSG #a :hello there', 512) == (
+        'PRIVMSG', ['#a', ':hello there'])
+    assert parser.parse('JOIN #a,#b', 512) == ('JOIN', ['#a,#b'])
+    assert parser.parse('NICK', 512) == ('NICK', [''])
+
+
+def test_errors():
+    assert error('PING \xAA\xAA\xAA\xAA') == '998'  # invalid utf8
+    assert error('UNKNOWNCOMMAND a b c') == '421'
+    assert error('PING ' + 'x' * 100, 100) == '417'  # too long
+
+
+def test_params():
+    # the endpoints split lines like the kernel functions expect
+    command.load_commands()
+    arities = dict((name, arity)
+                   for name, (f, arity) in command.commands.items())
+    assert arities == parser.params
@@ -0,0 +1,118 @@
+from ircd.kernel.redisutil import Redis
+from ircd.kernel.scripts import Script
+from testutil import *
+
+
+def round_trips(k, name):
+    count, round_trips = k.round_trips[name]
+    return float(round_trips) / count
+
+
+def test_join(kp):
+    user(1)
+
+    msg('JOIN #a')
+    assert pop() == 'test:__1 :test1!test1@::1 JOIN #a :H real name\r\n'
+    assert code() == '331'
+    assert code() == '353'
+    assert code() == '366'
+
+    msg('JOIN #a')
+    assert code() == '927'  # already joined
+
+
+def test_privmsg(kp):
+    user(1)
+    user(2)
+    msg('JOIN #a', 1)
+    msg('JOIN #a', 2)
+    popall()
+
+    msg('PRIVMSG #a :hi', 1)
+    assert pop() == 'test:__2 :test1!test1@::1 PRIVMSG #a :hi\r\n'
+    assert pop() is None
+
+    # load user, prefetch channel data, flush
+    assert round_trips(kp, 'PRIVMSG') == 3
+
+
+def test_part(kp):
+    user(1)
+    user(2)
+    msg('JOIN #a', 1)
+    msg('JOIN #a', 2)
+    popall()
+
+    msg('PART #a', 2)
+    tags, message = pop().split(' ', 1)
+    assert sorted(tags.split(',')) == ['test:__1', 'test:__2']
+    assert message == ':test2!test2@::2 PART #a\r\n'
+
+    msg('PRIVMSG #a :hi', 2)
+    assert code() == '442'  # not on channel
+
+    msg('PART #a', 1)
+    popall()
+
+    assert not r.exists('chan:#a')
+
+
+def test_unbuffered(k0):
+    user(1)
+    user(2)
+    msg('JOIN #a', 1)
+    msg('JOIN #a', 2)
+    popall()
+
+    msg('PRIVMSG #a :hi', 1)
+    assert round_trips(k0, 'PRIVMSG') == 4
+
+
+def test_visible(k0):
+    user(1)
+    user(2)
+    user(3)
+    msg('JOIN #a,#b,#c', 1)
+    msg('JOIN #a,#b', 2)
+    msg('JOIN #c', 3)
+    popall()
+
+    msg('AWAY :afk', 1)
+    assert code() == '306'
+    tags, message = pop().split(' ', 1)
+    assert sorted(tags.split(',')) == ['test:__2', 'test:__3']
+    assert message == ':test1!test1@::1 822 :afk\r\n'
+
+    # load user, save user, visible tags, push the reply and the broadcast
+    assert round_trips(k0, 'AWAY') == 4
+
+
+def test_coalesce(k0):
+    user(1)
+    user(2)
+    msg('JOIN #a', 2)
+    popall()
+
+    msg('JOIN #a', 1)
+    assert r.llen('mq:test') == 1
+    tags, line = envelope.loads(r.lindex('mq:test', 0))[1][-1]
+    assert tags == ['test:__1']
+    assert [l.split(' ')[1] for l in line.split('\r\n')[:-1]] == [
+        '331', '353', '366']
+
+    assert pop() == \
+        'test:__1,test:__2 :test1!test1@::1 JOIN #a :H real name\r\n'
+    assert code() == '331'
+
+
+def test_script_order():
+    redis = Redis(1, buffered=True)
+    script = Script("redis.call('set', KEYS[1], ARGV[1])")
+    redis.load_scripts([script])
+
+    # redis forgot the script, the writes still run in order
+    r.script_flush()
+    redis.script(script, ['x'], ['1'], write=True)
+    redis.set('x', '2')
+    redis.commit()
+    assert r.get('x') == '2'
@@ -0,0 +1,302 @@
+import time
+from ircd.common import envelope
+from ircd.servers.server import Server
+from testutil import Config, set_time
+
+
+class MQ(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        # without the time it was sent
+        self.messages.append(envelope.loads(message)[:3])
+
+
+def server(**options):
+    config = Config()
+    config.__dict__.update(options)
+    s = Server('test', config)
+    mq = MQ()
+    s.mqs = [{'high': mq, 'normal': mq}]
+    return s, mq.messages
+
+
+def test_parse():
+    s, messages = server()
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    s.user_message('test:__1', 'nick a\r\nfoo bar\nPING \xff\n')
+    s.flush()
+    assert messages == [
+        ['connect', 'test:__1', '::1'],
+        ['message', 'test:__1', ['NICK', ['a']]]]
+    assert lines == [
+        ':testserver 421 * FOO :Unknown command\r\n'
+        ':testserver 998 * :Non UTF-8 message\r\n']
+
+
+def test_keepalive():
+    old_time = time.time
+    set_time(0)
+
+    s, messages = server(endpoint_keepalive=True)
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    # answered locally
+    s.user_message('test:__1', 'PING abc\r\nPONG x\r\n')
+    s.flush()
+    assert lines == [':testserver PONG testserver abc\r\n']
+    assert len(messages) == 1
+
+    set_time(11)
+    s.timeout.check()
+    s.flush()
+    assert lines[-1] == 'PING :testserver\r\n'
+
+    set_time(22)
+    s.timeout.check()
+    assert lines[-1] == ''  # closed
+    assert messages[-1] == ['disconnect', 'test:__1', 'Ping timeout']
+    assert 'test:__1' not in s.users
+
+    time.time = old_time
+
+
+def test_framing():
+    s, messages = server()
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    s.user_message('test:__1', 'NICK a\r\nUSER a b c')
+    s.user_message('test:__1', ' :d\r')
+    s.user_message('test:__1', '\n\r\n\nAWAY :x\nAWAY')
+    assert messages[1:] == [
+        ['message', 'test:__1', ['NICK', ['a']]],
+        ['message', 'test:__1', ['USER', ['a', 'b', 'c', ':d']]],
+        ['message', 'test:__1', ['AWAY', [':x']]]]
+    assert s.buffers['test:__1'] == 'AWAY'
+
+
+def test_max_buffer():
+    s, messages = server()
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    # too long, but within the buffer limit
+    s.user_message('test:__1', 'AWAY :' + 'x' * 600 + '\n')
+    s.flush()
+    assert lines == [':testserver 417 * :Input line was too long\r\n']
+
+    # no newline in sight
+    s.user_message('test:__1', 'AWAY :' + 'x' * 600)
+    s.user_message('test:__1', 'x' * 600)
+    assert lines[-1] == ''
+    assert messages[-1] == [
+        'disconnect', 'test:__1', 'Input buffer exceeded']
+    assert 'test:__1' not in s.users
+
+
+def test_sendq():
+    s, messages = server()
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+    s.user_connect('test:__2', '::1', lines.append)
+
+    line = 'x' * 400
+    message = envelope.dumps(['test:__1', 'test:__2'], line)
+    s.server_message(message)
+    s.server_message(message)
+    assert s.sendq_bytes == 1600
+
+    # the first user reads its output, the second one doesn't
+    s.user_drained('test:__1')
+    assert s.sendqs == {'test:__1': 0, 'test:__2': 800}
+
+    s.server_message(message)
+    assert lines[-1] == ''
+    assert messages[-1] == ['disconnect', 'test:__2', 'SendQ exceeded']
+    assert s.sendqs == {'test:__1': 400}
+    assert s.sendq_bytes == 400
+    assert s.sendq_peak == 1600
+    assert s.sendq_exceeded == 1
+
+
+def test_coalesce():
+    s, messages = server(max_sendq=10000)
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    for i in range(3):
+        s.server_message(envelope.dumps(['test:__1'], 'line %d\r\n' % i))
+    assert lines == []
+    s.flush()
+    assert lines == ['line 0\r\nline 1\r\nline 2\r\n']
+
+    # written right away past flush_size
+    s.server_message(envelope.dumps(['test:__1'], 'x' * 5000))
+    assert lines[-1] == 'x' * 5000
+
+    # closed after the queued lines are written
+    s.user_drained('test:__1')
+    s.server_message(envelope.dumps(['test:__1'], 'bye\r\n'))
+    s.server_message(envelope.dumps(['test:__1'], ''))
+    assert lines[-2:] == ['bye\r\n', '']
+    assert (s.lines_out, s.writes) == (5, 3)
+
+
+def test_flood():
+    old_time = time.time
+    set_time(0)
+
+    s, messages = server()
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    # 10 lines of burst, then 2 lines per second
+    s.user_message('test:__1', 'AWAY\r\n' * 14)
+    assert len(messages) == 11
+    assert s.throttled == 4
+
+    set_time(1)
+    s.release('test:__1')
+    assert len(messages) == 13
+
+    # the queue is released in order, after the lines held before
+    set_time(1.5)
+    s.user_message('test:__1', 'NICK a\r\n')
+    set_time(2.5)
+    s.release('test:__1')
+    assert messages[-1] == ['message', 'test:__1', ['NICK', ['a']]]
+    assert 'test:__1' not in s.held
+
+    # more than 10 seconds behind
+    s.user_message('test:__1', 'AWAY\r\n' * 30)
+    assert messages[-1] == ['disconnect', 'test:__1', 'Excess Flood']
+    assert s.flooded == 1
+    assert s.ip_buckets['::1'][1] == 0
+
+    # the address bucket is forgotten once it has refilled
+    s.sweep_buckets()
+    assert '::1' in s.ip_buckets
+    set_time(60)
+    s.sweep_buckets()
+    assert s.ip_buckets == {}
+
+    time.time = old_time
+
+
+def test_flood_address():
+    old_time = time.time
+    set_time(0)
+
+    s, messages = server()
+    for i in range(6):
+        s.user_connect('test:__%d' % i, '::1', None)
+    s.user_connect('test:__6', '::2', None)
+
+    # the connections from ::1 share 50 lines of burst
+    for i in range(6):
+        s.user_message('test:__%d' % i, 'AWAY\r\n' * 10)
+    s.user_message('test:__6', 'AWAY\r\n' * 10)
+    assert s.throttled == 10
+    assert s.ip_buckets['::1'][1] == 6
+
+    time.time = old_time
+
+
+def test_flood_reconnect():
+    old_time = time.time
+    set_time(0)
+
+    s, messages = server()
+    for i in range(6):
+        s.user_connect('test:__%d' % i, '::1', None)
+        s.user_message('test:__%d' % i, 'AWAY\r\n' * 10)
+    for i in range(6):
+        s.user_disconnect('test:__%d' % i)
+    s.sweep_buckets()
+
+    # reconnecting doesn't pay back the debt of the address
+    s.user_connect('test:__6', '::1', None)
+    throttled = s.throttled
+    s.user_message('test:__6', 'AWAY\r\n')
+    assert s.throttled == throttled + 1
+
+    time.time = old_time
+
+
+def test_backpressure():
+    s, messages = server()
+    reads = []
+    for i in range(2):
+        s.user_connect('test:__%d' % i, '::1', None)
+
+    s.read_more('test:__0', lambda: reads.append(0))
+    assert reads == [0]
+
+    s.set_lags(['6.5', None])
+    assert s.paused
+    s.read_more('test:__0', lambda: reads.append(0))
+    s.read_more('test:__1', lambda: reads.append(1))
+    s.user_disconnect('test:__1')
+    assert reads == [0]
+
+    # still too far behind
+    s.set_lags(['2', None])
+    assert reads == [0]
+
+    s.set_lags(['0.5', '0.1'])
+    assert not s.paused
+    assert reads == [0, 0]
+    assert s.pauses == 1
+
+
+def test_chans():
+    s, messages = server()
+    lines = []
+    for i in range(3):
+        s.user_connect('test:__%d' % i, '::1', lines.append)
+
+    s.server_message(envelope.dumps('join', '#a', 'test:__0'))
+    s.server_message(envelope.dumps('join', '#a', 'test:__1'))
+    s.server_message(envelope.dumps('join', '#b', 'test:__1'))
+    # not a user of this server (anymore)
+    s.server_message(envelope.dumps('join', '#a', 'test:__9'))
+    assert s.chans == {'#a': set(['test:__0', 'test:__1']),
+                       '#b': set(['test:__1'])}
+
+    s.server_message(envelope.dumps('chan', '#a', 'test:__0', 'hi\r\n'))
+    s.flush()
+    assert lines == ['hi\r\n']
+
+    s.server_message(envelope.dumps('part', '#a', 'test:__0'))
+    s.user_disconnect('test:__1')
+    assert s.chans == {}
+    assert s.user_chans == {'test:__0': set(), 'test:__2': set()}
+
+
+def test_batch():
+    s, messages = server()
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    s.server_message(envelope.dumps('batch', [
+        ['join', '#a', 'test:__1'],
+        ['chan', '#a', '', 'JOIN\r\n'],
+        [['test:__1'], 'NAMES\r\nEND\r\n'],
+        [['test:__1'], '']]))
+    assert lines == ['JOIN\r\nNAMES\r\nEND\r\n', '']
+
+
+def test_bad_envelope():
+    s, messages = server()
+    lines = []
+    s.user_connect('test:__1', '::1', lines.append)
+
+    s.server_message('\x01' + envelope.dumps(['test:__1'], 'a\r\n')[1:])
+    s.server_message(envelope.dumps(['test:__1'], 'b\r\n'))
+    s.flush()
+    assert lines == ['b\r\n']
@@ -0,0 +1,142 @@
+from testutil import *
+from ircd.common import sharding
+
+# with 2 shards: #a and test:__1 belong to shard 1, #b and test:__2 to shard 0
+
+
+def shards():
+    r.flushdb()
+    chans.clear()
+    config = Config()
+    config.kernel_shards = 2
+    return [Kernel(config, 0), Kernel(config, 1)]
+
+
+def send(message):
+    """
+    Route a message like the endpoints do
+    """
+    kind, tag, data = message.split(' ', 2)
+    if kind == 'message':
+        cmd, params = parser.tokenize(data)
+        routes = [(shard, '%s %s' % (cmd, ' '.join(part)))
+                  for shard, part in sharding.route(tag, cmd, params, 2)]
+    else:
+        routes = [(sharding.shard_of(tag, 2), data)]
+
+    for shard, part in routes:
+        queue = sharding.kernel_queue(shard, 2)
+        r.rpush(queue, frame('%s %s %s' % (kind, tag, part)))
+
+
+def run(ks):
+    busy = True
+    while busy:
+        busy = False
+        for k in ks:
+            message = r.lpop(k.queue)
+            if message:
+                k.process_message(message)
+                busy = True
+
+
+def popmany():
+    messages = []
+    while True:
+        message = pop()
+        if not message:
+            return messages
+        messages.append(message)
+
+
+def register(n):
+    send('connect test:__%d ::%d' % (n, n))
+    send('message test:__%d USER test%d' % (n, n))
+    send('message test:__%d NICK test%d' % (n, n))
+
+
+def test_route():
+    assert sharding.route('test:__1', 'JOIN', ['#a,#b,#c key'], 2) == [
+        (0, ['#b,#c key']), (1, ['#a key'])]
+    assert sharding.route('test:__1', 'PRIVMSG', ['test2', ':hi'], 2) == [
+        (0, ['test2', ':hi'])]
+    assert sharding.route('test:__1', 'PART', ['#b :bye'], 2) == [
+        (0, ['#b :bye'])]
+    assert sharding.route('test:__1', 'AWAY', [':bbl'], 2) == [
+        (1, [':bbl'])]
+    assert sharding.route('test:__2', 'JOIN', ['#a'], 1) == [(0, ['#a'])]
+
+
+def test_chans():
+    ks = shards()
+    register(1)
+    register(2)
+    send('message test:__1 JOIN #a,#b')
+    send('message test:__2 JOIN #a,#b')
+    run(ks)
+    popall()
+
+    # each shard only processed the JOIN of its own channel
+    assert ks[0].round_trips['JOIN'][0] == 2
+    assert ks[1].round_trips['JOIN'][0] == 2
+
+    send('message test:__1 PRIVMSG #b :hi')
+    run(ks)
+    assert pop() == 'test:__2 :test1!test1@::1 PRIVMSG #b :hi\r\n'
+
+    send('message test:__2 PRIVMSG test1 :hi')
+    run(ks)
+    assert pop() == 'test:__1 :test2!test2@::2 PRIVMSG test1 :hi\r\n'
+
+
+def test_disconnect():
+    ks = shards()
+    register(1)
+    register(2)
+    send('message test:__1 JOIN #a,#b')
+    send('message test:__2 JOIN #a,#b')
+    run(ks)
+    popall()
+
+    send('disconnect test:__1 bye')
+    run(ks)
+
+    # a single QUIT, though they share two channels owned by two shards
+    assert popmany() == ['test:__2 :test1!test1@::1 QUIT :bye\r\n']
+
+    assert not r.exists('user:test:__1')
+    assert r.smembers('chan-users:#a') == set(['test:__2'])
+    assert r.smembers('chan-users:#b') == set(['test:__2'])
+
+
+def test_disconnect_join():
+    ks = shards()
+    register(1)
+    run(ks)
+    popall()
+
+    # shard 0 read the user just before its home shard disconnected it
+    user = ks[0].load_user('test:__1')
+    ks[0].load_user = lambda tag: user
+    send('message test:__1 JOIN #b')
+    send('disconnect test:__1 bye')
+    ks[1].process_message(r.lpop(ks[1].queue))
+    run(ks)
+
+    # the late join leaves no member and no empty channel behind
+    assert not r.exists('chan-users:#b')
+    assert not r.exists('chan-nicks:#b')
+    assert not r.exists('chan:#b')
+    assert not r.exists('user-chans:test:__1')
+
+
+def test_unregistered():
+    ks = shards()
+
+    # the JOIN reaches shard 0 before shard 1 registers the user
+    register(1)
+    send('message test:__1 JOIN #b')
+    run(ks)
+
+    assert 'test:__1 :test1!test1@::1 JOIN #b :H\r\n' in popmany()
+    assert r.smembers('chan-users:#b') == set(['test:__1'])
@@ -0,0 +1,92 @@
+import pytest
+from ircd.common import envelope
+from ircd.kernel.kernel import Kernel
+from testutil import r, kernel, frame, code, popall, Config
+
+
+def xadd(message, name='mq:kernel'):
+    r.execute_command('XADD', name, '*', 'm', frame(message))
+
+
+def pending(name='mq:kernel'):
+    return r.execute_command('XPENDING', name, 'kernel')[0]
+
+
+def test_loop():
+    k = kernel(streams=True, batch_size=2)
+
+    xadd('connect test:__1 ::1')
+    xadd('message test:__1 NICK test1')
+    xadd('message test:__1 USER test1')
+    xadd('shutdown test test')
+
+    k.loop()
+
+    assert code() == '001'
+    assert pending() == 0
+
+
+def test_recover():
+    k = kernel(streams=True)
+
+    xadd('connect test:__1 ::1')
+    xadd('message test:__1 NICK test1')
+
+    # the kernel dies before processing the batch it read
+    assert len(k.read_messages()) == 2
+    assert pending() == 2
+
+    xadd('message test:__1 USER test1')
+    xadd('shutdown test test')
+
+    # the new kernel processes the pending messages first
+    k = Kernel(k.config)
+    k.loop()
+
+    assert code() == '001'
+    assert pending() == 0
+    popall()
+
+
+def test_trim():
+    k = kernel(streams=True, stream_maxlen=10)
+
+    for i in range(1000):
+        k.enqueue(0, 'connect', 'test:__%d' % i, '::1')
+
+    assert 0 < r.execute_command('XLEN', 'mq:kernel:high') < 1000
+
+
+def test_bad_envelope():
+    k = kernel(streams=True)
+
+    r.execute_command('XADD', 'mq:kernel', '*', 'm', 'garbage')
+    xadd('connect test:__1 ::1')
+    xadd('shutdown test test')
+    k.loop()
+
+    # the message that can't be read is dropped, not left pending
+    assert r.exists('user:test:__1')
+    assert pending() == 0
+
+
+def test_poison():
+    kernel(streams=True)
+    config = Config()
+    config.streams = True
+
+    # a message that crashes the kernel on every delivery
+    r.execute_command('XADD', 'mq:kernel', '*', 'm', envelope.message(
+        'message', 'test:__1', ['AWAY']))
+    for i in range(config.stream_max_deliveries):
+        with pytest.raises(ValueError):
+            Kernel(config).loop()
+        assert pending() == 1
+
+    xadd('connect test:__1 ::1')
+    xadd('shutdown test test')
+    Kernel(config).loop()
+
+    assert pending() == 0
+    assert r.exists('user:test:__1')
+    assert r.execute_command('XLEN', 'mq:kernel:dead') == 1
@@ -52,3 +52,80 @@ def test_timeout2():
     assert not pop()
 
     time.time = old_time
+
+
+def test_wheel():
+    import random
+    from ircd.common.wheel import TimingWheel
+
+    random.seed(1)
+    wheel = TimingWheel(0)
+    deadlines = {}
+    for i in range(2000):
+        # from a few ticks to further than the top level reaches
+        deadlines[i] = random.choice([1, 10, 100, 10000, 2 ** 31]) * \
+            random.random() + 1
+        wheel.add(i, deadlines[i])
+
+    for i in range(0, 2000, 7):
+        wheel.remove(i)
+        del deadlines[i]
+
+    now = 0
+    while deadlines:
+        now += random.choice([0.5, 3, 70, 5000, 2 ** 24])
+        expired = wheel.advance(now)
+        assert sorted(expired) == sorted(
+            i for i, deadline in deadlines.items() if deadline <= now)
+        for i in expired:
+            del deadlines[i]
+
+    assert len(wheel) == 0
+
+
+def test_timeout_entries():
+    old_time = time.time
+    set_time(0)
+
+    k = k1()
+    for t in range(1, 100):
+        set_time(t / 10.0)
+        msg('PONG x')
+
+    # one scheduled check per user, however many messages it sent
+    assert len(k.timeout.wheel) == 1
+
+    time.time = old_time
+
+
+def test_timeout_threads():
+    import threading
+    from ircd.common.timeout import Timeout
+
+    class Server(object):
+        def send(self, tag, line):
+            pass
+
+        def disconnect(self, user):
+            pass
+
+    timeout = Timeout(Server(), Config())
+    tags = ['test:__%d' % i for i in range(1000)]
+
+    def update():
+        for _ in range(20):
+            for tag in tags:
+                timeout.update(tag)
+                timeout.remove(tag)
+                timeout.update(tag)
+
+    threads = [threading.Thread(target=update) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        timeout.check()
+    for thread in threads:
+        thread.join()
+
+    # each tag scheduled exactly once
+    assert len(timeout.wheel) == len(tags)
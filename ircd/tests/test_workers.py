@@ -0,0 +1,51 @@
+from testutil import *
+
+
+def push(message):
+    r.rpush('mq:kernel', frame(message))
+
+
+def test_classify(k0):
+    assert k0.classify(frame('message t:1 PRIVMSG #a :hi')) == '#a'
+    assert k0.classify(frame('message t:1 privmsg nick :hi')) == 'nick'
+    assert k0.classify(frame('message t:1 MODE #a +o nick')) == '#a'
+    assert k0.classify(frame('message t:1 JOIN #a,#b')) is None
+    assert k0.classify(frame('message t:1 MODE nick')) is None
+    assert k0.classify(frame('message t:1 AUTH x y')) is None
+    assert k0.classify(frame('connect t:1 ::1')) is None
+
+
+def test_order():
+    k = kernel(workers=4, pipeline=True, cache=True, cache_check=True)
+
+    chans = ['#a', '#b', '#c', '#d']
+    for n in range(1, 4):
+        push('connect test:__%d ::%d' % (n, n))
+        push('message test:__%d USER test%d' % (n, n))
+        push('message test:__%d NICK test%d' % (n, n))
+        for chan in chans:
+            push('message test:__%d JOIN %s' % (n, chan))
+
+    for i in range(20):
+        for chan in chans:
+            push('message test:__1 PRIVMSG %s :%d' % (chan, i))
+
+    push('disconnect test:__3 bye')
+    push('shutdown test test')
+    k.loop()
+
+    received = dict((chan, []) for chan in chans)
+    while True:
+        message = pop()
+        if not message:
+            break
+        if ' PRIVMSG ' in message:
+            tags, _, _, chan, text = message.split()
+            assert sorted(tags.split(',')) == ['test:__2', 'test:__3']
+            received[chan].append(int(text[1:]))
+
+    for chan in chans:
+        assert received[chan] == range(20)
+
+    assert k.cache.chan_users['#a'] == set(['test:__1', 'test:__2'])
+    assert k.round_trips['PRIVMSG'][0] == 80
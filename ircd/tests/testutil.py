@@ -1,25 +1,73 @@
 import pytest
 import redis
 import time
+from ircd.common import envelope, parser
+from ircd.common.util import split
 from ircd.kernel.kernel import Kernel
 
 r = redis.StrictRedis(db=1)
 k = None
 
+# chan name -> tags, the channel members kept by the test server
+chans = {}
+# 'tags line' messages unpacked but not popped yet
+pending = []
+
 
 class Config(object):
     server_name = 'testserver'
     ping_timeout = 10
+    endpoint_keepalive = False
+    batch_size = 100
+    kernel_shards = 1
+    workers = 0
+    streams = False
+    stream_maxlen = 1000
+    stream_max_deliveries = 3
     redis_db = 1
     hmac_key = 'key'
+    access_reap_interval = 60
+    join_names_limit = 0
+    max_line_length = 512
+    max_buffer = 1024
+    max_sendq = 1024
+    flush_size = 4096
+    flood_rate = 2
+    flood_burst = 10
+    flood_ip_rate = 10
+    flood_ip_burst = 50
+    flood_max_delay = 10
+    backpressure_high = 5
+    backpressure_low = 1
+    pipeline = False
+    cache = False
+    cache_check = False
+
+
+def kernel(**options):
+    global k
+    r.flushdb()
+    chans.clear()
+    del pending[:]
+    config = Config()
+    config.__dict__.update(options)
+    k = Kernel(config)
+    return k
 
 
 @pytest.fixture
 def k0():
-    global k
-    r.flushdb()
-    k = Kernel(Config())
-    return k
+    return kernel()
+
+
+@pytest.fixture
+def kp():
+    return kernel(pipeline=True)
+
+
+@pytest.fixture
+def kc():
+    return kernel(pipeline=True, cache=True, cache_check=True)
 
 
 @pytest.fixture
@@ -36,8 +84,24 @@ def user(n=1):
     popall()
 
 
+def frame(message):
+    """
+    Build the envelope of a 'kind origin data' message, like the servers do
+    """
+    kind, origin, data = split(message, 2)
+    if kind == 'message':
+        data = list(parser.tokenize(data))
+    return envelope.message(kind, origin, data)
+
+
 def raw(message):
-    k.process_message(message)
+    if message.startswith('disconnect '):
+        # the server forgets the user before telling the kernel
+        tag = message.split(' ')[1]
+        for members in chans.itervalues():
+            members.discard(tag)
+
+    k.process_message(frame(message))
 
 
 def msg(message, n=1):
@@ -45,7 +109,49 @@ def msg(message, n=1):
 
 
 def pop():
-    return r.lpop('mq:test')
+    """
+    Pop a line sent to the test server as 'tags line'
+    """
+    while not pending:
+        message = r.lpop('mq:test')
+        if message is None:
+            return None
+        unpack(envelope.loads(message))
+
+    return pending.pop(0)
+
+
+def unpack(fields):
+    """
+    Handle a message like the servers do, queueing its lines
+    """
+    if isinstance(fields[0], list):
+        tags, lines = fields
+        deliver(tags, lines)
+
+    elif fields[0] == 'chan':
+        _, chan, skip, lines = fields
+        deliver(sorted(chans.get(chan, set()) - set([skip])), lines)
+
+    elif fields[0] == 'join':
+        chans.setdefault(fields[1], set()).add(fields[2])
+
+    elif fields[0] == 'part':
+        chans.get(fields[1], set()).discard(fields[2])
+
+    elif fields[0] == 'batch':
+        for message in fields[1]:
+            unpack(message)
+
+
+def deliver(tags, lines):
+    if not tags:
+        return
+    if not lines:
+        # closed
+        pending.append('%s ' % ','.join(tags))
+    for line in lines.split('\r\n')[:-1]:
+        pending.append('%s %s\r\n' % (','.join(tags), line))
 
 
 def popall():
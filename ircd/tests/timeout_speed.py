@@ -0,0 +1,51 @@
+"""
+Ping timeout tracker with many active users
+
+Every user sends several messages per second. The number of scheduled checks
+stays at one per user and memory stays flat, however long it runs.
+
+Run from the top directory with: python -m ircd.tests.timeout_speed [users]
+"""
+import resource
+import sys
+import time
+from ircd.common.timeout import Timeout
+
+users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+rate = 4  # messages per user per second
+seconds = 30
+
+
+class Config(object):
+    server_name = 'test'
+    ping_timeout = 10
+
+
+class Server(object):
+    def send(self, tag, message):
+        pass
+
+    def disconnect(self, user):
+        pass
+
+
+# the tracker runs on a simulated clock
+clock = time.time
+now = 0.0
+time.time = lambda: now
+
+timeout = Timeout(Server(), Config())
+tags = ['test:__%d' % i for i in xrange(users)]
+
+for second in xrange(seconds):
+    start = clock()
+    for step in xrange(rate):
+        now = second + float(step) / rate
+        for tag in tags:
+            timeout.update(tag)
+        timeout.check()
+    duration = clock() - start
+
+    print 't=%2ds %8.0f updates/s %7d scheduled %7d KB max rss' % (
+        second, users * rate / duration, len(timeout.wheel),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
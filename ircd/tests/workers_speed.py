@@ -0,0 +1,86 @@
+"""
+Kernel throughput with different worker pool sizes
+
+The kernel talks to redis through a proxy that adds latency to every round
+trip, like a redis server on another host would. With no latency the kernel
+is CPU bound and the workers don't help.
+
+Run from the top directory with: python -m ircd.tests.workers_speed [ms]
+"""
+from __future__ import with_statement
+from timer import timer
+import logging
+import multiprocessing
+import redis
+import socket
+import sys
+import threading
+import time
+from ircd.kernel.kernel import Kernel
+from testutil import Config, frame
+
+r = redis.StrictRedis(db=1)
+latency = float(sys.argv[1] if len(sys.argv) > 1 else 0.5) / 1000
+proxy_port = 6380
+users = 200
+chans = 32
+n = 2000
+
+
+def pipe(src, dst):
+    while True:
+        data = src.recv(65536)
+        if not data:
+            break
+        time.sleep(latency / 2)
+        dst.sendall(data)
+
+
+def proxy():
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', proxy_port))
+    server.listen(100)
+    while True:
+        client, _ = server.accept()
+        upstream = socket.create_connection(('localhost', 6379))
+        for src, dst in [(client, upstream), (upstream, client)]:
+            thread = threading.Thread(target=pipe, args=(src, dst))
+            thread.daemon = True
+            thread.start()
+
+
+logging.getLogger().setLevel(logging.WARNING)
+multiprocessing.Process(target=proxy).start()
+time.sleep(0.5)
+
+for workers in [0, 1, 2, 4, 8, 16]:
+    r.flushdb()
+    config = Config()
+    config.workers = workers
+    k = Kernel(config)
+
+    for i in xrange(users):
+        k.process_message(frame('connect test:__%d ::%d' % (i, i)))
+        k.process_message(frame('message test:__%d USER u%d' % (i, i)))
+        k.process_message(frame('message test:__%d NICK u%d' % (i, i)))
+        k.process_message(frame('message test:__%d JOIN #%d' % (
+            i, i % chans)))
+
+    for i in xrange(n):
+        r.rpush('mq:kernel', frame('message test:__%d PRIVMSG #%d :hello' % (
+            i % users, i % chans)))
+    r.rpush('mq:kernel', frame('shutdown test test'))
+    r.delete('mq:test')
+
+    k.redis.connection_pool = redis.ConnectionPool(db=1, port=proxy_port)
+
+    with timer:
+        k.loop()
+
+    print 'workers', workers, '%.0f' % (n / timer.duration())
+
+print '(messages per second, %.1fms redis latency)' % (latency * 1000)
+
+for process in multiprocessing.active_children():
+    process.terminate()